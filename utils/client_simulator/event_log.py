@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+from src.event_log import parse_args, main
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
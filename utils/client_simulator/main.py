@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 from src.utils import parse_args
-from src.simulation_runner import main
+from src.simulation_runner import main, process
+from src.async_runner import async_process
+
+
+ENGINES = {
+    "thread": process,
+    "asyncio": async_process,
+}
 
 
 if __name__ == "__main__":
     args = parse_args()
-    main(args)
+    main(args, ENGINES[args.engine])
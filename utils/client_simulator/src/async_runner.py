@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+from .simulation_runner import Device, closed_cleanly, record_shutdown, get_worker_macs, pin_to_cpu, update_fd_limit, schedule_connects, \
+    bind_source_addresses, schedule_traffic, configure_commands, configure_pings, configure_replay, \
+    configure_roaming, configure_churn, ControlWatcher, OFFLINE_STATES, CONTROL_POLL_INTERVAL_S
+from .control import ControlBlock
+from .responder import CommandReply
+from .utils import Args
+from .scheduler import TimerWheel
+from .traffic import TrafficStream
+from .log import logger, setup_logging, stop_logging
+from . import event_log
+from . import stats
+from websockets.asyncio import client
+from websockets.exceptions import ConnectionClosed, WebSocketException
+from typing import Callable
+import multiprocessing
+import functools
+import threading
+import asyncio
+import signal
+import time
+import os
+
+
+STOP_POLL_INTERVAL_S = 0.05
+
+# keeps fire-and-forget tasks referenced until they are done
+background_tasks = set()
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def record_pong(pong_waiter: asyncio.Future):
+    # the pong waiter's result is the round trip time, it fails if the
+    # connection closes first
+    if not pong_waiter.cancelled() and pong_waiter.exception() is None:
+        stats.record("ping_rtt", pong_waiter.result())
+
+
+class AsyncDevice(Device):
+    """
+    Same device as `Device`, but driven as a coroutine instead of a thread.
+    All devices of a single worker process share one event loop.
+    """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wakeup = asyncio.Event()
+
+    def deliver(self, callback: Callable):
+        # the callback's coroutine runs next to the timers, on the event loop
+        if callback is not None:
+            run_in_background(callback())
+
+    async def send(self, socket: client.ClientConnection, data: str):
+        await socket.send(data)
+        self.record_sent(data)
+
+    async def send_traffic(self, stream: TrafficStream):
+        socket = self._socket
+        if socket is None:
+            return
+        logger.debug(f"{self.mac}: sending {stream.burst} x {stream.types}")
+        try:
+            for _ in range(stream.burst):
+                await self.send_message(socket, stream.pick())
+        except ConnectionClosed:
+            logger.warning(f"{self.mac}: connection closed, {stream.types} not sent")
+
+    async def send_message(self, socket: client.ClientConnection, message_type: str):
+        await self.send(socket, getattr(self.messages, message_type))
+
+    async def send_posted(self, frame: str):
+        socket = self._socket
+        if socket is None:
+            return
+        try:
+            await self.send(socket, frame)
+        except ConnectionClosed:
+            logger.debug(f"{self.mac}: connection closed, frame not sent")
+
+    async def send_ping(self, socket: client.ClientConnection):
+        try:
+            pong_waiter = await socket.ping()
+        except ConnectionClosed:
+            return
+        pong_waiter.add_done_callback(record_pong)
+
+    async def send_hello(self, socket: client.ClientConnection):
+        logger.debug(self.messages.connect)
+        await self.send(socket, self.messages.connect)
+
+    async def send_log(self, socket: client.ClientConnection):
+        await self.send(socket, self.messages.log)
+
+    async def send_state(self, socket: client.ClientConnection):
+        await self.send(socket, self.messages.state)
+
+    async def send_join(self, socket: client.ClientConnection):
+        await self.send(socket, self.messages.join)
+
+    async def send_leave(self, socket: client.ClientConnection):
+        await self.send(socket, self.messages.leave)
+
+    async def get_single_message(self, socket: client.ClientConnection):
+        try:
+            msg = self.messages.from_json(await asyncio.wait_for(socket.recv(), self.interval))
+            self.record_received(msg)
+            return msg
+        except TimeoutError:
+            return None
+
+    async def handle_messages(self, socket: client.ClientConnection, timeout: float = None):
+        try:
+            msg = await asyncio.wait_for(socket.recv(), timeout)
+        except TimeoutError:  # no messages
+            return
+        msg = self.parse_message(msg)
+        if msg is None:
+            return
+        self.record_received(msg)
+        logger.info(msg)
+        if "method" in msg:
+            await self.handle_command(socket, msg)
+        else:
+            logger.error(f"{self.mac}: received a message without method")
+
+    async def handle_command(self, socket: client.ClientConnection, msg: dict):
+        reply = self.command_reply(msg)
+        if reply.delay > 0:
+            self.wheel.schedule(time.monotonic() + reply.delay,
+                                functools.partial(self.on_command_done, socket, reply))
+        else:
+            await self.finish_command(socket, reply)
+
+    async def send_delayed_reply(self, socket: client.ClientConnection, reply: CommandReply):
+        if socket is not self._socket:
+            logger.warning(f"{self.mac}: connection closed, {reply.method} reply not sent")
+            return
+        await self.finish_command(socket, reply)
+
+    async def finish_command(self, socket: client.ClientConnection, reply: CommandReply):
+        await self.send(socket, self.messages.to_json(reply.result))
+        self.record_command(reply)
+        if reply.reboot:
+            self.start_reboot()
+            await self.disconnect()
+
+    async def connect(self):
+        if self._socket is None:
+            # keepalive pings are disabled to generate the same traffic as
+            # the thread engine does
+            start = self.record_connect_start()
+            self._socket = await client.connect(self.server_addr, ssl=self.get_connect_ssl_context(),
+                                                open_timeout=20, close_timeout=20,
+                                                ping_interval=None, local_addr=self.source_address)
+            self.record_connect(start)
+        return self._socket
+
+    async def disconnect(self):
+        if self._socket is not None:
+            socket, self._socket = self._socket, None
+            self.save_tls_session(socket.transport.get_extra_info("ssl_object"))
+            try:
+                await socket.close()
+            finally:
+                self.record_disconnect()
+
+    async def shutdown(self, timeout: float) -> bool:
+        socket = self._socket
+        if socket is None:
+            return None
+        self.state = "stopped"
+        socket.close_timeout = max(0.0, timeout)
+        try:
+            await asyncio.wait_for(self.disconnect(), timeout)
+        except TimeoutError:
+            # closing the TLS transport waits for the peer as well
+            socket.transport.abort()
+            return False
+        return closed_cleanly(socket)
+
+    def drop(self):
+        if self._socket is not None:
+            self._socket.transport.abort()
+
+    async def run_session(self):
+        self.state = "connecting"
+        await self.connect()
+        await self.send_hello(self._socket)
+        self.state = "connected"
+        self.backoff.reset()
+        self.schedule_session_end()
+        while self.state == "connected" and not self.parked and not self.stop_event.is_set():
+            await self.handle_messages(self._socket)
+
+    async def job(self):
+        await asyncio.sleep(self.start_delay)
+        logger.debug(f"{self.mac}: starting simulation")
+        self.schedule_traffic()
+        try:
+            while not self.stop_event.is_set():
+                if self.parked:
+                    self.state = "parked"
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    # unparked devices connect on the ramp of the scale up, see ControlWatcher
+                    await asyncio.sleep(self.start_delay)
+                    continue
+                try:
+                    await self.run_session()
+                except (WebSocketException, OSError, EOFError) as e:
+                    if self.state not in OFFLINE_STATES and not self.parked and not self.stop_event.is_set():
+                        self.record_connection_lost(e)
+                        await self.disconnect()
+                        await asyncio.sleep(self.backoff.next())
+                if self.state in OFFLINE_STATES:
+                    await self.wakeup.wait()
+        except Exception:
+            stats.count("errors")
+            raise
+        finally:
+            self.state = "stopped"
+            self.cancel_traffic()
+            await self.disconnect()
+        logger.debug(f"{self.mac}: simulation done")
+
+
+async def shutdown_devices(devices: list, timeout: float):
+    """Closes the connections of all devices at once, each within `timeout`."""
+    start = time.monotonic()
+    connected = [device for device in devices if device._socket is not None]
+    if not connected:
+        return
+    results = await asyncio.gather(*(device.shutdown(timeout) for device in connected), return_exceptions=True)
+    record_shutdown([result if not isinstance(result, Exception) else False for result in results],
+                    time.monotonic() - start)
+
+
+async def wait_for_stop(stop_event: multiprocessing.Event, tasks: list, devices: list, timeout: float):
+    while not stop_event.is_set() and not all(t.done() for t in tasks):
+        await asyncio.sleep(STOP_POLL_INTERVAL_S)
+    # devices blocked receiving are woken up by closing their connections,
+    # the rest (connecting, backing off, parked) are cancelled
+    await shutdown_devices(devices, timeout)
+    for t in tasks:
+        t.cancel()
+
+
+async def run_timer_wheel(wheel: TimerWheel):
+    while True:
+        await asyncio.sleep(wheel.resolution)
+        for callback in wheel.advance():
+            # a failing callback must not stop the timers of all other devices
+            try:
+                callback()
+            except Exception as e:
+                stats.count("errors")
+                logger.error(f"timer callback failed: {e!r}")
+
+
+async def run_control(watcher: ControlWatcher):
+    while True:
+        await asyncio.sleep(CONTROL_POLL_INTERVAL_S)
+        try:
+            watcher.poll()
+        except Exception as e:
+            logger.error(f"applying control changes failed: {e!r}")
+
+
+async def run_devices(devices: list, wheel: TimerWheel, stop_event: multiprocessing.Event,
+                      watcher: ControlWatcher = None, shutdown_timeout: float = 5):
+    timers = asyncio.create_task(run_timer_wheel(wheel))
+    control = asyncio.create_task(run_control(watcher)) if watcher is not None else None
+    tasks = [asyncio.create_task(d.job(), name=d.mac) for d in devices]
+    stopper = asyncio.create_task(wait_for_stop(stop_event, tasks, devices, shutdown_timeout))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    await stopper
+    timers.cancel()
+    if control is not None:
+        control.cancel()
+    for device, result in zip(devices, results):
+        if isinstance(result, Exception):
+            logger.error(f"{device.mac}: simulation failed: {result!r}")
+
+
+def async_process(args: Args, name: str, start_event: multiprocessing.Event, stop_event: multiprocessing.Event,
+                  stats_queue: multiprocessing.Queue = None, counters: stats.Counters = None, worker: int = 0,
+                  control: ControlBlock = None, histograms: stats.SharedHistograms = None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ignore Ctrl+C in child processes
+    setup_logging(args.log_rate, args.log_samples, args.log_file)
+    threading.current_thread().name = name
+    if counters is not None:
+        stats.attach_counters(counters, worker)
+    if histograms is not None:
+        stats.attach_histograms(histograms, worker)
+    if args.event_log:
+        event_log.attach_event_log(args.event_log, worker)
+    if args.pin_cpus:
+        pin_to_cpu(worker)
+    logger.info("process started (asyncio engine)")
+    macs = get_worker_macs(args, worker, args.workers)
+    update_fd_limit()
+
+    devices = [AsyncDevice(mac, args.server, args.ca_path, args.msg_interval, args.msg_size,
+                           os.path.join(args.cert_path, "base.crt"),
+                           os.path.join(args.cert_path, "base.key"),
+                           args.check_cert,
+                           start_event, stop_event,
+                           args.tls_session_reuse)
+               for _, mac in macs]
+    for device, (index, _) in zip(devices, macs):
+        device.index = index
+    schedule_connects(args, devices)
+    bind_source_addresses(args, devices, worker)
+    configure_commands(args, devices)
+    configure_pings(args, devices)
+    configure_replay(args, devices, worker)
+    configure_churn(args, devices)
+
+    logger.debug("waiting for start trigger")
+    start_event.wait()
+    if not stop_event.is_set():
+        wheel = TimerWheel()
+        schedule_traffic(args, devices, wheel, worker)
+        configure_roaming(args, devices, wheel)
+        watcher = ControlWatcher(args, control, devices, worker) if control is not None else None
+        asyncio.run(run_devices(devices, wheel, stop_event, watcher, args.shutdown_timeout))
+    if stats_queue is not None:
+        stats_queue.put(stats.histograms)
+    event_log.close_event_log()
+    stop_logging()
@@ -0,0 +1,158 @@
+from .utils import Args, parse_msg_size
+from .log import logger
+from . import stats
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import multiprocessing
+import socketserver
+import threading
+import ctypes
+import json
+import os
+
+
+class ControlBlock:
+    """
+    Settings the parent process changes while the simulation runs, in
+    shared memory. Only the parent writes, workers poll the values and
+    apply changes to their devices.
+    """
+
+    def __init__(self, args: Args):
+        # per MAC mask, like --number-of-connections
+        self.devices = multiprocessing.RawValue(ctypes.c_int64, args.number_of_connections)
+        # workers only have devices up to --max-connections per mask
+        self.max_devices = args.max_connections
+        self.msg_interval = multiprocessing.RawValue(ctypes.c_double, args.msg_interval)
+        self.msg_size = multiprocessing.RawValue(ctypes.c_int64, args.msg_size)
+        # every increment drops the connections of `disconnect_ratio` of the devices
+        self.disconnect_ratio = multiprocessing.RawValue(ctypes.c_double, 0)
+        self.disconnect_seq = multiprocessing.RawValue(ctypes.c_int64, 0)
+
+    def status(self) -> dict:
+        return {
+            "devices": self.devices.value,
+            "msg_interval": self.msg_interval.value,
+            "msg_size": self.msg_size.value,
+            "disconnects": self.disconnect_seq.value,
+        }
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """
+    GET  /status                   settings and counters
+    POST /start                    start the simulation (same as SIGUSR1)
+    POST /stop                     stop the simulation (same as Ctrl+C)
+    POST /devices?count=N          number of connected devices per MAC mask
+    POST /interval?seconds=S       message interval
+    POST /size?bytes=SIZE          log message payload size, e.g. 1k
+    POST /disconnect?ratio=R       drop the connection of R (0 to 1) of the devices
+    """
+
+    def reply(self, code: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/status":
+            return self.reply(404, {"error": "not found"})
+        server = self.server
+        self.reply(200, {"started": server.start_event.is_set(),
+                         "processes": server.counters.workers,
+                         **server.control.status(),
+                         "counters": server.counters.totals()})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        action = self.server.actions.get(url.path)
+        if action is None:
+            return self.reply(404, {"error": "not found"})
+        try:
+            action(self.server, query)
+        except (KeyError, ValueError) as e:
+            return self.reply(400, {"error": f"bad request: {e!r}"})
+        logger.info(f"control: {url.path} {query}")
+        self.reply(200, self.server.control.status())
+
+    def log_message(self, format, *args):
+        # client_address of a unix socket is not a tuple, see address_string
+        logger.debug(f"control: {format % args}")
+
+
+def start(server, query: dict):
+    server.start_event.set()
+
+
+def stop(server, query: dict):
+    server.stop_requested.set()
+
+
+def set_devices(server, query: dict):
+    count = int(query["count"])
+    if count < 0:
+        raise ValueError("count must not be negative")
+    if count > server.control.max_devices:
+        raise ValueError(f"count must not exceed --max-connections ({server.control.max_devices})")
+    server.control.devices.value = count
+
+
+def set_interval(server, query: dict):
+    seconds = float(query["seconds"])
+    if seconds <= 0:
+        raise ValueError("seconds must be positive")
+    server.control.msg_interval.value = seconds
+
+
+def set_size(server, query: dict):
+    server.control.msg_size.value = parse_msg_size(query["bytes"])
+
+
+def disconnect(server, query: dict):
+    ratio = float(query.get("ratio", 1))
+    if not 0 <= ratio <= 1:
+        raise ValueError("ratio must be between 0 and 1")
+    server.control.disconnect_ratio.value = ratio
+    server.control.disconnect_seq.value += 1
+
+
+ACTIONS = {
+    "/start": start,
+    "/stop": stop,
+    "/devices": set_devices,
+    "/interval": set_interval,
+    "/size": set_size,
+    "/disconnect": disconnect,
+}
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_control_server(address: str, control: ControlBlock, counters: stats.Counters,
+                         start_event: multiprocessing.Event, stop_requested: threading.Event):
+    """
+    Serves the control API on `address`, either HOST:PORT or unix:PATH, from
+    a background thread.
+    """
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = UnixHTTPServer(path, ControlHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), ControlHandler)
+    server.control = control
+    server.counters = counters
+    server.start_event = start_event
+    server.stop_requested = stop_requested
+    server.actions = ACTIONS
+    threading.Thread(target=server.serve_forever, name="control", daemon=True).start()
+    logger.info(f"control API listening on {address}")
+    return server
@@ -0,0 +1,83 @@
+from .traffic import parse_period
+from typing import List
+import random
+import math
+import re
+
+
+# number of parameters of every distribution
+PARAM_COUNT = {"const": 1, "uniform": 2, "normal": 2, "exp": 1, "lognormal": 2}
+
+
+class Distribution:
+    """
+    Random duration in seconds:
+
+    const(A)          always A
+    uniform(A,B)      uniformly distributed between A and B
+    normal(MEAN,SD)   normally distributed, negative samples are clipped to 0
+    exp(MEAN)         exponentially distributed
+    lognormal(MEDIAN,SIGMA)
+                      log-normally distributed, SIGMA is the standard
+                      deviation of the underlying normal distribution
+    """
+
+    def __init__(self, kind: str, params: List[float]):
+        self.kind = kind
+        self.params = params
+
+    def sample(self) -> float:
+        if self.kind == "const":
+            return self.params[0]
+        if self.kind == "uniform":
+            return random.uniform(*self.params)
+        if self.kind == "normal":
+            return max(0.0, random.gauss(*self.params))
+        if self.kind == "exp":
+            return random.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+        raise ValueError(f"Unknown distribution \"{self.kind}\"")
+
+    def mean(self) -> float:
+        if self.kind in ("const", "exp", "normal"):
+            # clipping negative samples of a normal distribution is ignored
+            return self.params[0]
+        if self.kind == "uniform":
+            return sum(self.params) / 2
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return median * math.exp(sigma ** 2 / 2)
+        raise ValueError(f"Unknown distribution \"{self.kind}\"")
+
+    def __repr__(self):
+        return f"{self.kind}({', '.join(f'{p:g}' for p in self.params)})"
+
+
+def parse_duration(input: str) -> float:
+    """Parses a duration with a unit (ms, s, m or h), plain numbers are seconds."""
+    input = input.strip()
+    if re.match(r"^\d+(?:\.\d+)?$", input):
+        return float(input)
+    return parse_period(input)
+
+
+def parse_distribution(spec: str) -> Distribution:
+    """
+    Parses a distribution, e.g. "10s", "uniform(5s,15s)", "normal(10s,2s)",
+    "exp(30s)" or "lognormal(10s,0.5)". A plain duration is a constant.
+    """
+    match = re.match(r"^(\w+)\((.*)\)$", spec.strip())
+    if match is None:
+        return Distribution("const", [parse_duration(spec)])
+    kind, params = match.groups()
+    if kind not in PARAM_COUNT:
+        raise ValueError(f"Unknown distribution \"{kind}\", expected one of {list(PARAM_COUNT)}")
+    params = params.split(",")
+    if len(params) != PARAM_COUNT[kind]:
+        raise ValueError(f"Distribution \"{kind}\" takes {PARAM_COUNT[kind]} parameters, got \"{spec}\"")
+    if kind == "lognormal":
+        # sigma is dimensionless
+        return Distribution(kind, [parse_duration(params[0]), float(params[1])])
+    return Distribution(kind, [parse_duration(p) for p in params])
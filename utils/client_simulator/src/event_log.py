@@ -0,0 +1,283 @@
+from .log import logger
+from websockets.exceptions import InvalidHandshake
+from dataclasses import dataclass
+from typing import Iterator, List
+import threading
+import argparse
+import struct
+import array
+import glob
+import math
+import re
+import time
+import ssl
+import sys
+
+
+MAGIC = b"WSEVLOG1"
+# magic, worker
+HEADER = struct.Struct("<8sI")
+# number of events of the chunk, followed by its columns
+CHUNK = struct.Struct("<I")
+# columns of every chunk, in file order: name, array type code
+COLUMNS = [
+    ("time", "d"),      # wall clock (epoch) seconds
+    ("mac", "Q"),       # device MAC as integer
+    ("kind", "B"),
+    ("reason", "B"),
+    ("value", "f"),     # seconds, NaN if the event has none
+]
+# events buffered before a chunk is written
+CHUNK_EVENTS = 65536
+# buffered events are written at least this often, however few they are
+FLUSH_INTERVAL_S = 1.0
+
+CONNECT_START = 0
+CONNECT_END = 1
+CONNECT_FAILED = 2
+FIRST_MESSAGE = 3
+DISCONNECT = 4
+RECONNECT = 5
+DOWNLINK = 6
+RESPONSE = 7
+KINDS = ["connect_start", "connect_end", "connect_failed", "first_message", "disconnect", "reconnect",
+         "downlink", "response"]
+
+# reasons of disconnect events, by the state of the device when it closed
+DISCONNECT_REASONS = ["closed", "lost", "reboot", "churn", "parked", "stopped"]
+DISCONNECT_STATES = {"backoff": 1, "rebooting": 2, "churning": 3, "parked": 4, "stopped": 5}
+# reasons of connect failures
+FAILURE_REASONS = ["other", "timeout", "refused", "tls", "handshake"]
+# reasons of responses
+RESPONSE_REASONS = ["ok", "error"]
+REASONS = {CONNECT_FAILED: FAILURE_REASONS, DISCONNECT: DISCONNECT_REASONS, RESPONSE: RESPONSE_REASONS}
+
+NO_VALUE = math.nan
+
+
+def failure_reason(error: Exception) -> int:
+    if isinstance(error, TimeoutError):
+        return 1
+    if isinstance(error, ConnectionRefusedError):
+        return 2
+    if isinstance(error, ssl.SSLError):
+        return 3
+    if isinstance(error, InvalidHandshake):
+        return 4
+    return 0
+
+
+def mac_to_int(mac: str) -> int:
+    return int(mac.replace(":", ""), 16)
+
+
+def int_to_mac(value: int) -> str:
+    return ":".join(f"{value >> shift & 0xFF:02X}" for shift in range(40, -8, -8))
+
+
+class EventWriter:
+    """
+    Appends the lifecycle events of the devices of a worker to a columnar
+    file. Events are buffered in one array per column and written as a
+    chunk, each column's values one after the other, so a loader reads a
+    column of a chunk with a single call. Values are little endian. A file
+    that was cut short is readable up to its last complete chunk; chunks are
+    also written every FLUSH_INTERVAL_S, so the file of a running or crashed
+    worker misses at most the events of the last interval.
+    """
+
+    def __init__(self, path: str, worker: int):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, worker))
+        self.columns = [array.array(code) for _, code in COLUMNS]
+        self.events = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        threading.Thread(target=self._flush_periodically, name="event-log", daemon=True).start()
+
+    def log(self, mac: str, kind: int, value: float = NO_VALUE, reason: int = 0):
+        times, macs, kinds, reasons, values = self.columns
+        with self._lock:
+            times.append(time.time())
+            macs.append(mac_to_int(mac))
+            kinds.append(kind)
+            reasons.append(reason)
+            values.append(value)
+            if len(times) >= CHUNK_EVENTS:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        count = len(self.columns[0])
+        if count == 0:
+            return
+        self.file.write(CHUNK.pack(count))
+        for column in self.columns:
+            if sys.byteorder == "big":
+                column.byteswap()
+            column.tofile(self.file)
+        self.columns = [array.array(code) for _, code in COLUMNS]
+        self.events += count
+
+    def _flush_periodically(self):
+        while not self._closed.wait(FLUSH_INTERVAL_S):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self.file.closed:
+                return
+            self._write_chunk()
+            self.file.flush()
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self._write_chunk()
+            self.file.close()
+        logger.info(f"{self.events} lifecycle events written to {self.path}")
+
+
+# the event log of the current worker process, see attach_event_log
+_writer = None
+
+
+def attach_event_log(prefix: str, worker: int):
+    global _writer
+    _writer = EventWriter(f"{prefix}.{worker}", worker)
+
+
+def close_event_log():
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+def log_event(mac: str, kind: int, value: float = NO_VALUE, reason: int = 0):
+    if _writer is not None:
+        _writer.log(mac, kind, value, reason)
+
+
+@dataclass
+class Event:
+    time: float
+    mac: str
+    kind: str
+    reason: str
+    value: float
+
+
+class EventTable:
+    """Events of all workers of a run, one array per column, ordered by time."""
+
+    def __init__(self, columns: List[array.array]):
+        self.time, self.mac, self.kind, self.reason, self.value = columns
+
+    def __len__(self):
+        return len(self.time)
+
+    def event(self, i: int) -> Event:
+        kind = self.kind[i]
+        reasons = REASONS.get(kind)
+        return Event(self.time[i], int_to_mac(self.mac[i]), KINDS[kind],
+                     reasons[self.reason[i]] if reasons else "", self.value[i])
+
+    def select(self, kind: int = None, mac: str = None) -> Iterator[Event]:
+        mac = mac_to_int(mac) if mac is not None else None
+        for i in range(len(self)):
+            if (kind is None or self.kind[i] == kind) and (mac is None or self.mac[i] == mac):
+                yield self.event(i)
+
+
+def read_chunks(path: str) -> Iterator[List[array.array]]:
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+            raise ValueError(f"{path} is not an event log")
+        while True:
+            head = f.read(CHUNK.size)
+            if len(head) < CHUNK.size:
+                return
+            count, = CHUNK.unpack(head)
+            columns = []
+            for _, code in COLUMNS:
+                column = array.array(code)
+                try:
+                    column.fromfile(f, count)
+                except EOFError:
+                    return
+                if sys.byteorder == "big":
+                    column.byteswap()
+                columns.append(column)
+            yield columns
+
+
+def load_event_logs(paths: List[str]) -> EventTable:
+    """
+    Merges the event logs of all workers. A path may also be the prefix
+    given to --event-log, which stands for the logs of all its workers.
+    """
+    files = []
+    for path in paths:
+        # only the logs of the workers, PREFIX.<worker>, not e.g. exports
+        workers = [name for name in glob.glob(f"{glob.escape(path)}.*")
+                   if re.fullmatch(r"[0-9]+", name[len(path) + 1:])]
+        files.extend(sorted(workers) or [path])
+    merged = [array.array(code) for _, code in COLUMNS]
+    for path in files:
+        for columns in read_chunks(path):
+            for target, column in zip(merged, columns):
+                target.extend(column)
+    # events of a worker are in order already, only the workers are interleaved
+    order = sorted(range(len(merged[0])), key=merged[0].__getitem__)
+    return EventTable([array.array(code, map(column.__getitem__, order))
+                       for (_, code), column in zip(COLUMNS, merged)])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Summarizes or exports the lifecycle event logs written with --event-log.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("paths", metavar="PATH", nargs="+",
+                        help="event logs, or the prefix given to --event-log for the logs of all workers")
+    parser.add_argument("-d", "--device", metavar="MAC", type=str,
+                        default=None,
+                        help="print the events of a single device")
+    parser.add_argument("-k", "--kind", choices=KINDS,
+                        default=None,
+                        help="only print or export events of this kind")
+    parser.add_argument("--csv", metavar="FILE", type=str,
+                        default=None,
+                        help="export the (selected) events to FILE as CSV")
+    return parser.parse_args()
+
+
+def main(args):
+    table = load_event_logs(args.paths)
+    kind = KINDS.index(args.kind) if args.kind is not None else None
+    if args.csv:
+        with open(args.csv, "w") as f:
+            f.write("time,mac,kind,reason,value\n")
+            for event in table.select(kind, args.device):
+                f.write(f"{event.time:.6f},{event.mac},{event.kind},{event.reason},"
+                        f"{'' if math.isnan(event.value) else f'{event.value:.6f}'}\n")
+        logger.info(f"events written to {args.csv}")
+    elif args.device is not None or kind is not None:
+        for event in table.select(kind, args.device):
+            reason = f" {event.reason}" if event.reason else ""
+            value = "" if math.isnan(event.value) else f" {event.value * 1000:.1f}ms"
+            timestamp = time.strftime("%H:%M:%S", time.localtime(event.time)) + f".{int(event.time % 1 * 1000):03d}"
+            logger.info(f"{timestamp} {event.mac} {event.kind}{reason}{value}")
+    else:
+        counts = {}
+        for i in range(len(table)):
+            key = (table.kind[i], table.reason[i])
+            counts[key] = counts.get(key, 0) + 1
+        devices = len(set(table.mac))
+        span = table.time[-1] - table.time[0] if len(table) else 0
+        logger.info(f"{len(table)} events of {devices} devices over {span:.1f}s")
+        for (kind, reason), count in sorted(counts.items()):
+            reasons = REASONS.get(kind)
+            logger.info(f"{KINDS[kind]}{f' ({reasons[reason]})' if reasons else ''}: {count}")
@@ -1,4 +1,12 @@
+from typing import Dict
+import logging.handlers
+import threading
 import logging
+import random
+import queue
+import time
+import json
+import os
 
 
 TRACE_LEVEL = logging.DEBUG - 5
@@ -14,21 +22,100 @@ class ColoredFormatter(logging.Formatter):
     white = "\x1b[37;20m"
     cyan = "\x1b[36;20m"
     reset = "\x1b[0m"
-    format = "{asctime}|{levelname}|{threadName}|{funcName}:{lineno}\t{message}"
+    format_string = "{asctime}|{levelname}|{threadName}|{funcName}:{lineno}\t{message}"
 
     FORMATS = {
-        logging.DEBUG: grey + format + reset,
-        logging.INFO: cyan + format + reset,
-        logging.WARNING: yellow + format + reset,
-        logging.ERROR: red + format + reset,
-        logging.CRITICAL: bold_red + format + reset,
-        TRACE_LEVEL: white + format + reset
+        logging.DEBUG: grey + format_string + reset,
+        logging.INFO: cyan + format_string + reset,
+        logging.WARNING: yellow + format_string + reset,
+        logging.ERROR: red + format_string + reset,
+        logging.CRITICAL: bold_red + format_string + reset,
+        TRACE_LEVEL: white + format_string + reset
     }
 
+    def __init__(self):
+        super().__init__()
+        # one formatter per level, built once instead of once per record
+        self.formatters = {level: logging.Formatter(log_fmt, style="{") for level, log_fmt in self.FORMATS.items()}
+        self.fallback = logging.Formatter(self.format_string, style="{")
+
+    def format(self, record):
+        return self.formatters.get(record.levelno, self.fallback).format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, for the JSONL log file."""
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt, style="{")
-        return formatter.format(record)
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "process": record.processName,
+            "thread": record.threadName,
+            "category": record.funcName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits how many records of a category are logged. The category of a
+    record is the name of the function that logged it, e.g.
+    "record_connection_lost".
+
+    `rate`     records per second and category, with bursts of up to `burst`
+               records; 0 disables the limit
+    `samples`  maps a category to the ratio (0 to 1) of its records that are
+               logged at all
+
+    Critical records are always logged. The first record let through after
+    others were dropped mentions how many were dropped.
+    """
+
+    def __init__(self, rate: float = 0, burst: float = None, samples: Dict[str, float] = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.samples = samples or {}
+        # category -> [tokens, last update, dropped records]
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.CRITICAL:
+            return True
+        category = record.funcName
+        ratio = self.samples.get(category)
+        if ratio is not None and random.random() >= ratio:
+            return False
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self.buckets.get(category)
+            if bucket is None:
+                bucket = self.buckets[category] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                return False
+            bucket[0] = tokens - 1
+            dropped, bucket[2] = bucket[2], 0
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} similar messages dropped)"
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # the queue never leaves the process, so records are passed as they
+        # are and all formatting happens in the listener thread
+        return record
 
 
 def __trace(self, msg, *args, **kwargs):
@@ -55,3 +142,44 @@ logger = logging.getLogger(__name__)
 logger.propagate = False
 logger.addHandler(console)
 logging.getLogger('websockets.client').setLevel(logging.INFO)
+logging.getLogger('websockets.server').setLevel(logging.WARNING)
+
+# the listener of the process that called setup_logging last
+_listener = None
+_listener_pid = None
+
+
+def setup_logging(rate: float = 0, samples: Dict[str, float] = None, path: str = None):
+    """
+    Moves formatting and writing of the simulator's log records to a
+    background thread of the calling process, drops records above the rate
+    limits (see RateLimitFilter) and, if `path` is given, also appends all
+    records to it as JSON lines. Has to be called by every process, as
+    forked processes do not inherit the thread.
+    """
+    global _listener, _listener_pid
+    stop_logging()
+    handlers = [console]
+    if path:
+        file = logging.FileHandler(path)
+        file.setFormatter(JsonFormatter())
+        handlers.append(file)
+    log_queue = queue.SimpleQueue()
+    handler = LogQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(rate, samples=samples))
+    logger.handlers = [handler]
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener_pid = os.getpid()
+    _listener.start()
+
+
+def stop_logging():
+    """Writes out queued records and stops the listener started by setup_logging."""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        for handler in _listener.handlers:
+            if handler is not console:
+                handler.close()
+    _listener = None
+    logger.handlers = [console]
@@ -0,0 +1,165 @@
+from .log import logger
+from typing import List, Tuple
+import functools
+import struct
+import mmap
+import os
+
+
+MAGIC = b"MACSTOR1"
+HEADER = struct.Struct("<8sQ")
+ENTRY_SIZE = 6
+MAC_BITS = 48
+NIBBLES = MAC_BITS // 4
+
+
+def parse_mask(mask: str) -> Tuple[int, int, int]:
+    """
+    Returns the bits a mask fixes, their values and the number of leading
+    fixed nibbles. X (or x) is a wildcard nibble, missing trailing nibbles
+    are wildcards too, e.g. "AA:BB" matches AA:BB:XX:XX:XX:XX.
+    """
+    nibbles = mask.replace(":", "").upper()
+    if len(nibbles) > NIBBLES:
+        raise ValueError(f"MAC mask \"{mask}\" is too long")
+    care = pattern = 0
+    prefix = None
+    for i, nibble in enumerate(nibbles):
+        shift = 4 * (NIBBLES - 1 - i)
+        if nibble == "X":
+            if prefix is None:
+                prefix = i
+            continue
+        try:
+            pattern |= int(nibble, 16) << shift
+        except ValueError:
+            raise ValueError(f"Invalid character \"{nibble}\" in MAC mask \"{mask}\"") from None
+        care |= 0xF << shift
+    if prefix is None:
+        prefix = len(nibbles)
+    return care, pattern, prefix
+
+
+class MacStore:
+    """
+    Sorted, de-duplicated MAC addresses stored as 6 byte big endian
+    integers, so their byte order is their numeric order. Devices of a mask
+    sharing a fixed prefix (e.g. AA:BB:XX:XX:XX:XX) form a contiguous range,
+    found with two binary searches; only masks with wildcards before fixed
+    nibbles need to look at every entry of their prefix range.
+    """
+
+    def __init__(self, data, count: int, offset: int = HEADER.size):
+        self.data = data
+        self.count = count
+        self.offset = offset
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, index: int) -> bytes:
+        start = self.offset + index * ENTRY_SIZE
+        return self.data[start:start + ENTRY_SIZE]
+
+    def entry_block(self, start: int, end: int) -> bytes:
+        return self.data[self.offset + start * ENTRY_SIZE:self.offset + end * ENTRY_SIZE]
+
+    def bisect(self, value: int) -> int:
+        """Index of the first MAC that is not smaller than `value`."""
+        if value >= 1 << MAC_BITS:
+            return self.count
+        key = value.to_bytes(ENTRY_SIZE, "big")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, mask: str) -> Tuple[int, int, int, int]:
+        """Returns the index range of the mask's prefix and the bits the mask fixes (with their values)."""
+        care, pattern, prefix = parse_mask(mask)
+        free_bits = 4 * (NIBBLES - prefix)
+        first = pattern >> free_bits << free_bits
+        return self.bisect(first), self.bisect(first + (1 << free_bits)), care, pattern
+
+    @staticmethod
+    def is_prefix(care: int) -> bool:
+        # all fixed bits are leading bits, so every MAC of the range matches
+        free = (1 << MAC_BITS) - 1 - care
+        return free & (free + 1) == 0
+
+    def matches(self, mask: str):
+        start, end, care, pattern = self.range(mask)
+        exact = self.is_prefix(care)
+        for index in range(start, end):
+            entry = self.entry(index)
+            if exact or int.from_bytes(entry, "big") & care == pattern:
+                yield entry
+
+    def select(self, mask: str, limit: int = None) -> List[str]:
+        start, end, care, _ = self.range(mask)
+        if self.is_prefix(care):
+            # a plain slice of the store, read in one go
+            if limit is not None:
+                end = min(end, start + limit)
+            block = self.entry_block(start, end)
+            return [block[i:i + ENTRY_SIZE].hex(":").upper() for i in range(0, len(block), ENTRY_SIZE)]
+        macs = []
+        for entry in self.matches(mask):
+            if limit is not None and len(macs) >= limit:
+                break
+            macs.append(entry.hex(":").upper())
+        return macs
+
+    def count_matches(self, mask: str) -> int:
+        start, end, care, _ = self.range(mask)
+        if self.is_prefix(care):
+            return end - start
+        return sum(1 for _ in self.matches(mask))
+
+
+def parse_macs(text: str) -> List[int]:
+    return sorted({int(mac.replace(":", ""), 16) for mac in text.split()})
+
+
+def build_store(text_path: str, store_path: str) -> int:
+    with open(text_path, "r") as f:
+        values = parse_macs(f.read())
+    tmp_path = f"{store_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(values)))
+        f.write(b"".join(value.to_bytes(ENTRY_SIZE, "big") for value in values))
+    # replaced atomically, processes never see a partial store
+    os.replace(tmp_path, store_path)
+    return len(values)
+
+
+@functools.cache
+def get_mac_store(path: str) -> MacStore:
+    """
+    Opens the binary store of `path`/macs.txt, (re)building it next to the
+    text file when it is missing or older. If the directory is read-only
+    the store is built in memory instead.
+    """
+    text_path = os.path.join(path, "macs.txt")
+    store_path = os.path.join(path, "macs.bin")
+    try:
+        if not os.path.exists(store_path) or os.path.getmtime(store_path) < os.path.getmtime(text_path):
+            count = build_store(text_path, store_path)
+            logger.info(f"indexed {count} MAC addresses in {store_path}")
+    except OSError as e:
+        logger.warning(f"unable to write {store_path}, indexing MAC addresses in memory: {e!r}")
+        with open(text_path, "r") as f:
+            values = parse_macs(f.read())
+        data = b"".join(value.to_bytes(ENTRY_SIZE, "big") for value in values)
+        return MacStore(data, len(values), offset=0)
+
+    with open(store_path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, count = HEADER.unpack_from(data)
+    if magic != MAGIC or len(data) != HEADER.size + count * ENTRY_SIZE:
+        raise ValueError(f"{store_path} is not a valid MAC store, remove it to rebuild")
+    return MacStore(data, count)
@@ -0,0 +1,111 @@
+from .simulation_runner import Device, Message
+from .async_runner import AsyncDevice
+from .utils import parse_msg_size
+from .log import logger
+from dataclasses import dataclass
+import multiprocessing
+import tracemalloc
+import argparse
+import resource
+import time
+import os
+
+
+ENGINE_DEVICES = {
+    "thread": Device,
+    "asyncio": AsyncDevice,
+}
+
+
+@dataclass
+class BenchmarkArgs:
+    count: int
+    msg_size: int
+    engine: str
+    ca_path: str
+    cert_path: str
+
+
+def parse_args() -> BenchmarkArgs:
+    parser = argparse.ArgumentParser(
+        description="Measures the memory a simulated device needs, without connecting it.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-N", "--number-of-devices", metavar="NUMBER", type=int,
+                        default=10000,
+                        help="number of devices to create")
+    parser.add_argument("-p", "--payload-size", metavar="SIZE", type=str,
+                        default="1M",
+                        help="size of each client message")
+    parser.add_argument("-e", "--engine", choices=list(ENGINE_DEVICES),
+                        default="asyncio",
+                        help="engine whose devices are measured")
+    parser.add_argument("-a", "--ca-cert", metavar="CERT",
+                        default="./certs/ca/ca.crt",
+                        help="path to CA certificate")
+    parser.add_argument("-c", "--client-certs-path", metavar="PATH",
+                        default="./certs/client",
+                        help="path to client certificates directory")
+
+    parsed_args = parser.parse_args()
+    return BenchmarkArgs(count=parsed_args.number_of_devices,
+                         msg_size=parse_msg_size(parsed_args.payload_size),
+                         engine=parsed_args.engine,
+                         ca_path=parsed_args.ca_cert,
+                         cert_path=parsed_args.client_certs_path)
+
+
+FRAMES = ("connect", "state", "state_obf", "reboot_response", "log", "join", "leave")
+# frames rendered again for every send, see Message
+RENDERED_FRAMES = ("state", "log")
+RENDER_REPEATS = 100
+
+
+def frames_size(messages: Message) -> int:
+    """Size of all frames of a device, i.e. what a device storing rendered frames would need."""
+    return sum(len(getattr(messages, name)) for name in FRAMES)
+
+
+def render_time(messages: Message, name: str) -> float:
+    """Seconds to render a frame, the CPU a send spends instead of the memory to keep it."""
+    start = time.perf_counter()
+    for _ in range(RENDER_REPEATS):
+        getattr(messages, name)
+    return (time.perf_counter() - start) / RENDER_REPEATS
+
+
+def main(args: BenchmarkArgs):
+    start_event = multiprocessing.Event()
+    stop_event = multiprocessing.Event()
+    cls = ENGINE_DEVICES[args.engine]
+
+    def create(mac: str) -> Device:
+        return cls(mac, "wss://localhost:15002", args.ca_path, 10, args.msg_size,
+                   os.path.join(args.cert_path, "base.crt"),
+                   os.path.join(args.cert_path, "base.key"),
+                   True, start_event, stop_event)
+
+    # the shared parts (SSL context, templates, payload) are created by the
+    # first device and not counted per device
+    first = create("00:00:00:00:00:00")
+    first.messages.log
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    devices = [create(f"02:00:{i >> 24 & 0xFF:02X}:{i >> 16 & 0xFF:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}")
+               for i in range(args.count)]
+    # as after their first sends, devices keep their small frames
+    for device in devices:
+        frames_size(device.messages)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    per_device = (after - before) / len(devices)
+    frames = frames_size(first.messages)
+    logger.info(f"{len(devices)} {args.engine} devices, payload {args.msg_size} bytes")
+    logger.info(f"per device: {per_device:.0f} bytes (rendered frames would add {frames} bytes, "
+                f"{frames / per_device:.0f}x)")
+    logger.info(f"all devices: {(after - before) / 1e6:.1f} MB, "
+                f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3:.1f} MB")
+    for name in RENDERED_FRAMES:
+        logger.info(f"{name} frame: {len(getattr(first.messages, name))} bytes rendered per send in "
+                    f"{render_time(first.messages, name) * 1e6:.1f} us")
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+from .simulation_runner import DOWNLINK_TIMESTAMP_KEY, collect_histograms
+from .traffic import parse_period
+from .log import logger
+from . import stats
+from websockets.asyncio.server import serve, ServerConnection
+from websockets.exceptions import ConnectionClosed
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+import multiprocessing
+import collections
+import threading
+import argparse
+import asyncio
+import random
+import signal
+import json
+import time
+import ssl
+import re
+
+
+# seconds a device has to send its connect message after the WSS handshake
+CONNECT_TIMEOUT_S = 10
+COMMAND_TICK_S = 0.01
+STOP_POLL_INTERVAL_S = 0.5
+
+COMMAND_METHODS = ["reboot", "configure", "factory", "ping"]
+
+MOCK_COUNTERS = [
+    "connections",
+    "disconnects",
+    "handshake_failures",
+    "messages",
+    "bytes",
+    "connect",
+    "state",
+    "log",
+    "event",
+    "commands_sent",
+    "results",
+    "result_errors",
+    "command_timeouts",
+]
+
+
+@dataclass
+class MockArgs:
+    address: str = "0.0.0.0"
+    port: int = 15002
+    cert: str = None
+    key: str = None
+    ca: str = None
+    workers: int = 1
+    commands: List[Tuple[str, float]] = field(default_factory=list)
+    command_timeout: float = 30
+    latency_report: str = None
+
+
+def parse_command_rate(input: str) -> Tuple[str, float]:
+    match = re.match(r"^(\w+):(\d+(?:\.\d+)?)/([\d.]*(?:ms|s|m|h))$", input)
+    if match is None:
+        raise ValueError(f"Unable to parse command rate \"{input}\"")
+    method, count, period = match.groups()
+    if method not in COMMAND_METHODS:
+        raise ValueError(f"Unknown command \"{method}\", expected one of {COMMAND_METHODS}")
+    return method, float(count) / parse_period(period)
+
+
+def parse_args() -> MockArgs:
+    parser = argparse.ArgumentParser(
+        description="Minimal stand-in for CGW, used to measure how much load the client simulator can generate.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-l", "--listen", metavar="ADDRESS:PORT",
+                        default="0.0.0.0:15002",
+                        help="address and port to accept device connections on")
+    parser.add_argument("--cert", metavar="CERT",
+                        default=None,
+                        help="path to server certificate; without it the server speaks plain ws")
+    parser.add_argument("--key", metavar="KEY",
+                        default=None,
+                        help="path to server key")
+    parser.add_argument("-a", "--ca-cert", metavar="CERT",
+                        default=None,
+                        help="path to CA certificate; if given, devices must present a client "
+                             "certificate signed by it")
+    parser.add_argument("-w", "--workers", metavar="NUMBER", type=int,
+                        default=1,
+                        help="number of server processes sharing the listening port")
+    parser.add_argument("--command", metavar="METHOD:N/PERIOD", action="append",
+                        default=[],
+                        help=f"send N commands of METHOD ({', '.join(COMMAND_METHODS)}) every PERIOD "
+                             "to random connected devices, e.g. \"reboot:10/s\"")
+    parser.add_argument("--command-timeout", metavar="SECONDS", type=float,
+                        default=30,
+                        help="give up waiting for a command result after SECONDS")
+    parser.add_argument("--latency-report", metavar="FILE", type=str,
+                        default=None,
+                        help="write command latency percentiles to FILE (JSON) on exit")
+
+    parsed_args = parser.parse_args()
+
+    match = re.match(r"^([\d\w\.:-]*?):?(\d+)?$", parsed_args.listen)
+    if match is None:
+        raise ValueError(f"Unable to parse listen address {parsed_args.listen}")
+    args = MockArgs(cert=parsed_args.cert,
+                    key=parsed_args.key,
+                    ca=parsed_args.ca_cert,
+                    workers=parsed_args.workers,
+                    commands=[parse_command_rate(c) for c in parsed_args.command],
+                    command_timeout=parsed_args.command_timeout,
+                    latency_report=parsed_args.latency_report)
+    addr, port = match.groups()
+    if addr:
+        args.address = addr
+    if port is not None:
+        args.port = int(port)
+    return args
+
+
+def get_server_ssl_context(cert: str, key: str, ca: str = None) -> ssl.SSLContext:
+    if cert is None:
+        return None
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(cert, key)
+    if ca is not None:
+        # like CGW, only accept devices with a valid client certificate
+        ssl_context.load_verify_locations(ca)
+        ssl_context.verify_mode = ssl.CERT_REQUIRED
+    return ssl_context
+
+
+class Session:
+    __slots__ = ("serial", "socket", "pending")
+
+    def __init__(self, serial: str, socket: ServerConnection):
+        self.serial = serial
+        self.socket = socket
+        # (id, method, sent at) of the command waiting for its result, CGW
+        # also has at most one command in flight per device
+        self.pending = None
+
+
+class SessionPool:
+    """Connected devices with O(1) insert, removal and random pick."""
+
+    def __init__(self):
+        self.sessions: List[Session] = []
+        self.index: Dict[Session, int] = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, session: Session):
+        self.index[session] = len(self.sessions)
+        self.sessions.append(session)
+
+    def remove(self, session: Session):
+        i = self.index.pop(session, None)
+        if i is None:
+            return
+        last = self.sessions.pop()
+        if last is not session:
+            self.sessions[i] = last
+            self.index[last] = i
+
+    def pick(self) -> Session:
+        return random.choice(self.sessions) if self.sessions else None
+
+
+def parse_frame(data) -> dict:
+    """Parses a frame of a device, raises ValueError for anything but a JSON object."""
+    msg = json.loads(data)
+    if not isinstance(msg, dict):
+        raise ValueError(f"frame is not a JSON object: {data[:100]!r}")
+    return msg
+
+
+class MockGateway:
+    """
+    Accepts device connections and speaks just enough of the uCentral
+    protocol to keep them going: expects `connect` as the first message,
+    counts everything the devices send and matches command results to the
+    commands it issued.
+    """
+
+    def __init__(self, args: MockArgs, counters: stats.Counters, worker: int):
+        self.args = args
+        self.counters = counters
+        self.worker = worker
+        self.sessions = SessionPool()
+        # (id, session) of the commands sent, oldest first; commands share
+        # the timeout, so they also expire in this order. Entries of answered
+        # commands are skipped when they come up.
+        self.waiting = collections.deque()
+        self.next_id = 1
+        self.histograms: Dict[str, stats.Histogram] = {}
+
+    def count(self, name: str, value: int = 1):
+        self.counters.add(self.worker, name, value)
+
+    async def handler(self, socket: ServerConnection):
+        self.count("connections")
+        session = None
+        try:
+            msg = parse_frame(await asyncio.wait_for(socket.recv(), CONNECT_TIMEOUT_S))
+            params = msg.get("params")
+            if msg.get("method") != "connect" or not isinstance(params, dict) or "serial" not in params:
+                self.count("handshake_failures")
+                return
+            self.count("connect")
+            session = Session(msg["params"]["serial"], socket)
+            self.sessions.add(session)
+            async for data in socket:
+                self.on_message(session, data)
+        except (ConnectionClosed, TimeoutError, ValueError) as e:
+            if session is None:
+                self.count("handshake_failures")
+            logger.debug(f"connection closed: {e!r}")
+        finally:
+            if session is not None:
+                self.sessions.remove(session)
+                session.pending = None
+            self.count("disconnects")
+
+    def on_message(self, session: Session, data: str):
+        self.count("messages")
+        self.count("bytes", len(data))
+        msg = parse_frame(data)
+        method = msg.get("method")
+        if method in ("state", "log", "event"):
+            self.count(method)
+        elif "result" in msg:
+            self.on_result(session, msg["result"])
+
+    def on_result(self, session: Session, result: dict):
+        if not isinstance(result, dict) or not isinstance(result.get("status", {}), dict):
+            raise ValueError(f"{session.serial}: malformed result {result!r}")
+        self.count("results")
+        if result.get("status", {}).get("error", 0) != 0:
+            self.count("result_errors")
+        if session.pending is None or result.get("id") != session.pending[0]:
+            logger.warning(f"{session.serial}: unexpected result {result.get('id')}")
+            return
+        _, method, sent_at = session.pending
+        session.pending = None
+        histogram = self.histograms.setdefault(f"command_{method}", stats.Histogram())
+        histogram.record(time.monotonic() - sent_at)
+
+    async def send_command(self, session: Session, method: str):
+        params = {"serial": session.serial, "when": 0, DOWNLINK_TIMESTAMP_KEY: time.time()}
+        if method == "configure":
+            params["uuid"] = int(time.time())
+            params["config"] = {}
+        msg = {"jsonrpc": "2.0", "method": method, "id": self.next_id, "params": params}
+        session.pending = (self.next_id, method, time.monotonic())
+        self.waiting.append((self.next_id, session))
+        self.next_id += 1
+        self.count("commands_sent")
+        try:
+            await session.socket.send(json.dumps(msg))
+        except ConnectionClosed:
+            pass
+
+    def expire_commands(self):
+        deadline = time.monotonic() - self.args.command_timeout
+        while self.waiting:
+            command_id, session = self.waiting[0]
+            pending = session.pending
+            if pending is not None and pending[0] == command_id:
+                if pending[2] >= deadline:
+                    return
+                session.pending = None
+                self.count("command_timeouts")
+            self.waiting.popleft()
+
+    async def issue_commands(self, method: str, rate: float):
+        # commands are sent in batches every tick, so high rates do not
+        # need a sleep per command
+        credit = 0.0
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(COMMAND_TICK_S)
+            now = time.monotonic()
+            credit += (now - last) * rate
+            last = now
+            while credit >= 1:
+                credit -= 1
+                session = self.sessions.pick()
+                if session is not None and session.pending is None:
+                    await self.send_command(session, method)
+            self.expire_commands()
+
+    async def run(self, stop_event: multiprocessing.Event):
+        ssl_context = get_server_ssl_context(self.args.cert, self.args.key, self.args.ca)
+        async with serve(self.handler, self.args.address, self.args.port, ssl=ssl_context,
+                         reuse_port=self.args.workers > 1, ping_interval=None, max_size=None):
+            # the command rates are shared by all workers
+            tasks = [asyncio.create_task(self.issue_commands(method, rate / self.args.workers))
+                     for method, rate in self.args.commands]
+            while not stop_event.is_set():
+                await asyncio.sleep(STOP_POLL_INTERVAL_S)
+            for task in tasks:
+                task.cancel()
+
+
+def mock_process(args: MockArgs, stop_event: multiprocessing.Event, stats_queue: multiprocessing.Queue,
+                 counters: stats.Counters, worker: int):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ignore Ctrl+C in child processes
+    threading.current_thread().name = f"mock-{worker}"
+    gateway = MockGateway(args, counters, worker)
+    asyncio.run(gateway.run(stop_event))
+    stats_queue.put(gateway.histograms)
+
+
+def format_counters(totals: Dict[str, int], last: Dict[str, int], elapsed: float) -> str:
+    def rate(name):
+        return (totals[name] - last[name]) / elapsed
+    return (f"connections {totals['connections'] - totals['disconnects']}, "
+            f"received {rate('messages'):.0f} msg/s ({rate('bytes') / 1e6:.2f} MB/s: "
+            f"state {rate('state'):.0f}/s, log {rate('log'):.0f}/s, event {rate('event'):.0f}/s), "
+            f"connects {rate('connect'):.0f}/s, commands {rate('commands_sent'):.0f}/s, "
+            f"results {rate('results'):.0f}/s ({totals['result_errors']} failed, "
+            f"{totals['command_timeouts']} timed out), handshake failures {totals['handshake_failures']}")
+
+
+def main(args: MockArgs):
+    stop_event = multiprocessing.Event()
+    stats_queue = multiprocessing.Queue()
+    counters = stats.Counters(args.workers, MOCK_COUNTERS)
+    processes = [multiprocessing.Process(target=mock_process,
+                                         args=(args, stop_event, stats_queue, counters, worker))
+                 for worker in range(args.workers)]
+    proto = "wss" if args.cert else "ws"
+    logger.info(f"listening on {proto}://{args.address}:{args.port} with {args.workers} processes")
+    last, last_time = counters.totals(), time.monotonic()
+    try:
+        for p in processes:
+            p.start()
+        while True:
+            time.sleep(1)
+            totals, now = counters.totals(), time.monotonic()
+            logger.info(format_counters(totals, last, now - last_time))
+            last, last_time = totals, now
+    except KeyboardInterrupt:
+        logger.warning("Stopping all processes...")
+        stop_event.set()
+        histograms = collect_histograms(processes, stats_queue)
+        [p.join() for p in processes]
+        for line in stats.format_histograms(histograms):
+            logger.info(line)
+        if args.latency_report:
+            stats.dump_histograms(histograms, args.latency_report)
+            logger.info(f"latency report written to {args.latency_report}")
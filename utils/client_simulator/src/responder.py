@@ -0,0 +1,115 @@
+from .distribution import Distribution, parse_distribution
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+import random
+import time
+import re
+
+
+@dataclass
+class CommandModel:
+    """How a device answers a downlink command: after `delay` seconds, failing with `error_ratio` probability."""
+    delay: Distribution = field(default_factory=lambda: Distribution("const", [0]))
+    error_ratio: float = 0.0
+
+
+@dataclass
+class CommandReply:
+    method: str
+    delay: float
+    result: dict
+    error: bool
+    # the device reboots once the reply is sent
+    reboot: bool = False
+
+
+# error code and text of a simulated failure
+ERROR_CODE = 1
+ERROR_TEXT = "Simulated failure"
+
+
+def configure_result(msg: dict, result: dict):
+    # the device reports the uuid of the configuration it applied
+    params = msg.get("params") or {}
+    if isinstance(params, dict) and "uuid" in params:
+        result["uuid"] = params["uuid"]
+    result["status"]["rejected"] = []
+
+
+def ping_result(msg: dict, result: dict):
+    result["deviceUTCTime"] = int(time.time())
+
+
+# method specific parts of a reply; methods without a handler get the plain
+# result with only the status, which is all CGW needs to complete a request
+RESULT_HANDLERS: Dict[str, Callable[[dict, dict], None]] = {
+    "configure": configure_result,
+    "ping": ping_result,
+}
+
+# methods after which the device reboots
+REBOOT_METHODS = {"reboot", "factory"}
+
+
+def register_result_handler(method: str, handler: Callable[[dict, dict], None]):
+    RESULT_HANDLERS[method] = handler
+
+
+class CommandResponder:
+    """
+    Builds the replies of a device to downlink commands. Shared by all
+    devices of a process; `models` maps a method to its reply model, methods
+    without one use `default`.
+    """
+
+    def __init__(self, models: Dict[str, CommandModel] = None, default: CommandModel = None):
+        self.models = models or {}
+        self.default = default or CommandModel()
+
+    def model(self, method: str) -> CommandModel:
+        return self.models.get(method, self.default)
+
+    def reply(self, msg: dict, result: dict) -> CommandReply:
+        """Fills in `result`, a copy of the device's result template, as the reply to `msg`."""
+        method = msg.get("method")
+        model = self.model(method)
+        if "id" in msg:
+            result["result"]["id"] = msg["id"]
+        else:
+            del result["result"]["id"]
+        error = random.random() < model.error_ratio
+        if error:
+            result["result"]["status"]["error"] = ERROR_CODE
+            result["result"]["status"]["text"] = ERROR_TEXT
+        elif method in RESULT_HANDLERS:
+            RESULT_HANDLERS[method](msg, result["result"])
+        return CommandReply(method, model.delay.sample(), result, error,
+                            reboot=not error and method in REBOOT_METHODS)
+
+
+def parse_command_models(specs: List[str]) -> Dict[str, CommandModel]:
+    """
+    Parses reply models of downlink commands, one per entry:
+
+    METHOD:DELAY            reply to METHOD after DELAY, a duration or a
+                            distribution (see parse_distribution)
+    METHOD:DELAY:RATIO      same, but fail RATIO (0 to 1) of the commands
+
+    METHOD "*" sets the model of all methods without their own.
+    """
+    models = {}
+    for spec in specs:
+        match = re.match(r"^(\w+|\*):([^:]+)(?::(\d*\.?\d+))?$", spec.strip())
+        if match is None:
+            raise ValueError(f"Unable to parse command reply model \"{spec}\"")
+        method, delay, ratio = match.groups()
+        ratio = float(ratio) if ratio is not None else 0.0
+        if ratio > 1:
+            raise ValueError(f"Error ratio of \"{spec}\" must be between 0 and 1")
+        models[method] = CommandModel(parse_distribution(delay), ratio)
+    return models
+
+
+def get_command_responder(specs: List[str]) -> CommandResponder:
+    models = parse_command_models(specs)
+    return CommandResponder(models, models.pop("*", None))
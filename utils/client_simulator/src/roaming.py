@@ -0,0 +1,129 @@
+from .utils import get_msg_templates
+from .distribution import Distribution
+from .scheduler import TimerWheel
+from . import stats
+import functools
+import hashlib
+import random
+import time
+import json
+
+
+# the old AP reports a roamed client as gone this long after the new AP
+# reported its join, so CGW sees the join first and records a migration
+ROAM_LEAVE_DELAY_S = 1.0
+BANDS = {
+    "2G": [1, 6, 11],
+    "5G": [36, 40, 44, 48, 149, 153, 157, 161],
+}
+
+
+def client_mac(group: str, index: int) -> str:
+    """Locally administered MAC of the `index`th client of the group whose first AP is `group`."""
+    digest = hashlib.blake2b(f"{group}/{index}".encode(), digest_size=5).digest()
+    return ":".join(f"{b:02x}" for b in b"\x0a" + digest)
+
+
+def bssid(ap: str, band: str) -> str:
+    # every radio of an AP gets its own locally administered BSSID
+    first = int(ap[:2], 16) | 0x02 | (list(BANDS).index(band) << 2)
+    return f"{first:02x}{ap[2:]}".lower()
+
+
+def client_event(ap: str, kind: str, payload: dict) -> str:
+    template = get_msg_templates()[kind]["params"]["data"]["event"][1]
+    # the template's payload provides the fields that are not simulated,
+    # e.g. the cloud header
+    payload = dict(template["payload"], **payload)
+    return json.dumps({"jsonrpc": "2.0", "method": "event",
+                       "params": {"serial": ap,
+                                  "data": {"event": [int(time.time()), {"type": template["type"],
+                                                                        "payload": payload}]}}})
+
+
+class WirelessClient:
+    __slots__ = ("mac", "ap", "band", "joined_at")
+
+    def __init__(self, mac: str):
+        self.mac = mac
+        # device of the AP the client is associated with, None while away
+        self.ap = None
+        self.band = None
+        self.joined_at = 0.0
+
+
+class RoamingGroup:
+    """
+    Wireless clients moving between the APs of one infra group. A client
+    stays associated with an AP for a `dwell` time, then either roams to
+    another AP of the group (with probability `ratio`) or leaves the group
+    for an `away` time. A roam is a join on the new AP followed by a leave on
+    the old one, which CGW's topology map turns into a client migration.
+    Clients only join connected APs; events of APs that lost their
+    connection meanwhile are dropped.
+    """
+
+    def __init__(self, aps: list, clients: int, wheel: TimerWheel,
+                 dwell: Distribution, away: Distribution, ratio: float):
+        self.aps = aps
+        self.wheel = wheel
+        self.dwell = dwell
+        self.away = away
+        self.ratio = ratio
+        self.clients = [WirelessClient(client_mac(aps[0].mac, i)) for i in range(clients)]
+
+    def start(self):
+        now = time.monotonic()
+        for client in self.clients:
+            # clients arrive spread over an away time, not all at once
+            self.schedule(client, now + self.away.sample() * random.random())
+
+    def schedule(self, client: WirelessClient, when: float):
+        self.wheel.schedule(when, functools.partial(self.on_transition, client))
+
+    def connected_aps(self, exclude=None) -> list:
+        return [ap for ap in self.aps if ap._socket is not None and ap is not exclude]
+
+    def on_transition(self, client: WirelessClient):
+        now = time.monotonic()
+        if client.ap is None:
+            aps = self.connected_aps()
+            if aps:
+                self.join(client, random.choice(aps), now)
+                self.schedule(client, now + self.dwell.sample())
+            else:
+                self.schedule(client, now + self.away.sample())
+            return
+        aps = self.connected_aps(exclude=client.ap)
+        if aps and random.random() < self.ratio:
+            old = (client.mac, client.ap, client.band, client.joined_at)
+            self.join(client, random.choice(aps), now)
+            self.wheel.schedule(now + ROAM_LEAVE_DELAY_S, functools.partial(self.post_leave, *old))
+            stats.count("client_roams")
+            self.schedule(client, now + self.dwell.sample())
+        else:
+            self.post_leave(client.mac, client.ap, client.band, client.joined_at)
+            client.ap = None
+            self.schedule(client, now + self.away.sample())
+
+    def join(self, client: WirelessClient, ap, now: float):
+        band = random.choice(list(BANDS))
+        client.ap = ap
+        client.band = band
+        client.joined_at = now
+        stats.count("client_joins")
+        ap.post(client_event(ap.mac, "join", {
+            "client": client.mac,
+            "bssid": bssid(ap.mac, band),
+            "channel": random.choice(BANDS[band]),
+            "band": band,
+            "rssi": random.randint(-80, -40),
+        }))
+
+    def post_leave(self, mac: str, ap, band: str, joined_at: float):
+        stats.count("client_leaves")
+        ap.post(client_event(ap.mac, "leave", {
+            "client": mac,
+            "band": band,
+            "connected_time": round(time.monotonic() - joined_at),
+        }))
@@ -0,0 +1,178 @@
+from .distribution import parse_duration
+from .control import ControlBlock
+from .utils import Args
+from .log import logger
+from . import stats
+from urllib.request import urlopen
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Tuple
+import multiprocessing
+import threading
+import time
+import json
+import re
+
+
+# fraction of a step's hold time spent letting the load settle before its
+# rates are measured
+SETTLE_FRACTION = 0.25
+METRICS_TIMEOUT_S = 5
+SLO_PERCENTILE = 99
+
+
+def parse_latency_slo(input: str) -> Tuple[str, float]:
+    """Parses NAME:DURATION, the p99 of the live histogram NAME must stay below DURATION."""
+    name, _, limit = input.partition(":")
+    if name not in stats.LIVE_HISTOGRAMS:
+        raise ValueError(f"Unknown latency \"{name}\", expected one of {stats.LIVE_HISTOGRAMS}")
+    return name, parse_duration(limit)
+
+
+def get_cgw_metrics(url: str) -> Dict[str, float]:
+    """Returns the cgw_* gauges of a CGW metrics endpoint, e.g. http://cgw:8080/metrics."""
+    with urlopen(url, timeout=METRICS_TIMEOUT_S) as response:
+        text = response.read().decode()
+    return {name: float(value) for name, value in re.findall(r"^(cgw_\w+) ([\d.eE+-]+)$", text, re.MULTILINE)}
+
+
+@dataclass
+class Step:
+    devices: int
+    msg_interval: float
+    connected: int = 0
+    msgs_per_s: float = 0
+    latency_p99_s: float = 0
+    latency_samples: int = 0
+    error_ratio: float = 0
+    cgw: Dict[str, Dict[str, float]] = field(default_factory=dict)
+    breaches: List[str] = field(default_factory=list)
+
+
+class SaturationFinder:
+    """
+    Raises the load step by step through the control block, by adding devices
+    or by sending faster, until the latency or the error ratio of a step
+    breaks its SLO or devices fail to stay connected. The last step within
+    the SLO is the maximum sustainable load.
+
+    The error ratio of a step is the number of failed connects, lost
+    connections and errors over all connect attempts and sent messages. When
+    sending faster, a step also fails if less than half of the added message
+    rate is actually sent.
+    """
+
+    def __init__(self, args: Args, control: ControlBlock, counters: stats.Counters,
+                 histograms: stats.SharedHistograms):
+        self.args = args
+        self.control = control
+        self.counters = counters
+        self.histograms = histograms
+        self.latency, self.latency_limit = parse_latency_slo(args.slo_latency)
+        self.steps: List[Step] = []
+
+    def next_load(self, step: Step) -> Tuple[int, float]:
+        if self.args.saturate == "devices":
+            if step.devices >= self.args.max_connections:
+                return None
+            return min(step.devices + self.args.saturate_step, self.args.max_connections), step.msg_interval
+        return step.devices, step.msg_interval / self.args.saturate_rate_step
+
+    def measure(self, step: Step, stop: threading.Event) -> bool:
+        # latencies are measured over the whole step, they include the
+        # connects of the step's new devices; rates only once settled
+        start_buckets = self.histograms.buckets()[self.latency]
+        self.control.devices.value = step.devices
+        self.control.msg_interval.value = step.msg_interval
+        if stop.wait(self.args.saturate_hold * SETTLE_FRACTION):
+            return False
+        start, start_time = self.counters.totals(), time.monotonic()
+        if stop.wait(self.args.saturate_hold * (1 - SETTLE_FRACTION)):
+            return False
+        end, elapsed = self.counters.totals(), time.monotonic() - start_time
+        buckets = [b - a for a, b in zip(start_buckets, self.histograms.buckets()[self.latency])]
+
+        def delta(name):
+            return end[name] - start[name]
+        latency = stats.Histogram.from_buckets(buckets)
+        step.connected = end["connects"] - end["disconnects"]
+        step.msgs_per_s = delta("messages_sent") / elapsed
+        step.latency_p99_s = latency.percentile(SLO_PERCENTILE)
+        step.latency_samples = latency.total
+        failures = delta("connect_failures") + delta("connection_lost") + delta("errors")
+        step.error_ratio = failures / max(1, delta("connects") + delta("messages_sent") + delta("connect_failures"))
+        for url in self.args.cgw_metrics:
+            try:
+                step.cgw[url] = get_cgw_metrics(url)
+            except (OSError, ValueError) as e:
+                logger.warning(f"unable to read CGW metrics from {url}: {e!r}")
+
+        expected = step.devices * len(self.args.masks)
+        if latency.total and step.latency_p99_s > self.latency_limit:
+            step.breaches.append(f"{self.latency} p99 {step.latency_p99_s * 1000:.1f}ms")
+        if step.error_ratio > self.args.slo_errors:
+            step.breaches.append(f"error ratio {step.error_ratio:.4f}")
+        if step.connected < expected * self.args.slo_connected:
+            step.breaches.append(f"{step.connected} of {expected} devices connected")
+        if self.args.saturate == "rate" and self.steps:
+            previous = self.steps[-1].msgs_per_s
+            offered = previous * self.args.saturate_rate_step
+            if step.msgs_per_s < (previous + offered) / 2:
+                step.breaches.append(f"sent {step.msgs_per_s:.0f} of {offered:.0f} msg/s")
+        return True
+
+    def run(self, start_event: multiprocessing.Event, stop: threading.Event):
+        while not start_event.wait(1):
+            if stop.is_set():
+                return
+        load = (self.control.devices.value, self.control.msg_interval.value)
+        while load is not None:
+            step = Step(*load)
+            logger.info(f"saturation: {step.devices} devices per mask, message interval {step.msg_interval:g}s")
+            if not self.measure(step, stop):
+                return
+            self.steps.append(step)
+            logger.info(f"saturation: {step.connected} connected, {step.msgs_per_s:.0f} msg/s, "
+                        f"{self.latency} p99 {step.latency_p99_s * 1000:.1f}ms ({step.latency_samples} samples), "
+                        f"error ratio {step.error_ratio:.4f}")
+            if step.breaches:
+                logger.warning(f"saturation: SLO broken: {', '.join(step.breaches)}")
+                break
+            load = self.next_load(step)
+        self.report()
+        stop.set()
+
+    def report(self) -> dict:
+        good = [step for step in self.steps if not step.breaches]
+        best = good[-1] if good else None
+        report = {
+            "mode": self.args.saturate,
+            "slo": {"latency": self.latency, "p99_s": self.latency_limit, "error_ratio": self.args.slo_errors,
+                    "connected_ratio": self.args.slo_connected},
+            "saturated": bool(self.steps) and bool(self.steps[-1].breaches),
+            "max_connections": best.connected if best else 0,
+            "max_msgs_per_s": best.msgs_per_s if best else 0,
+            "cgw": {},
+            "steps": [asdict(step) for step in self.steps],
+        }
+        if best is not None:
+            # CGW has no message counter, its share of the messages is
+            # estimated from its share of the connections
+            total = sum(metrics.get("cgw_connections_num", 0) for metrics in best.cgw.values())
+            for url, metrics in best.cgw.items():
+                connections = metrics.get("cgw_connections_num", 0)
+                report["cgw"][url] = {"connections": connections,
+                                      "msgs_per_s": best.msgs_per_s * connections / total if total else 0}
+        if best is None:
+            logger.warning("saturation: the SLO was broken by the first step")
+        else:
+            logger.info(f"saturation: max sustainable load {report['max_connections']} connections, "
+                        f"{report['max_msgs_per_s']:.0f} msg/s"
+                        f"{'' if report['saturated'] else ' (load limit reached before the SLO broke)'}")
+            for url, instance in report["cgw"].items():
+                logger.info(f"saturation: {url}: {instance['connections']:.0f} connections, "
+                            f"~{instance['msgs_per_s']:.0f} msg/s")
+        if self.args.saturation_report:
+            with open(self.args.saturation_report, "w") as f:
+                json.dump(report, f, indent=4)
+            logger.info(f"saturation report written to {self.args.saturation_report}")
+        return report
@@ -0,0 +1,154 @@
+from .log import logger
+from . import stats
+from typing import Callable, List
+import itertools
+import threading
+import random
+import math
+import time
+
+
+RAMP_PROFILES = ["linear", "step", "poisson"]
+
+
+def connect_offsets(count: int, rate: float, profile: str = "linear",
+                    step: int = 1, jitter: float = 0.0) -> List[float]:
+    """
+    Returns, for each of `count` devices, the delay in seconds after the
+    simulation start at which the device should open its connection.
+
+    linear:  devices arrive one by one at a constant `rate` per second
+    step:    devices arrive in batches of `step`, with the batch period chosen
+             so the average arrival rate is still `rate` per second
+    poisson: exponentially distributed inter-arrival times with mean 1/`rate`
+
+    `jitter` adds a uniformly distributed delay of [0, jitter) seconds to
+    every device. A `rate` of 0 starts all devices at once.
+    """
+    if rate <= 0:
+        offsets = [0.0] * count
+    elif profile == "linear":
+        offsets = [i / rate for i in range(count)]
+    elif profile == "step":
+        offsets = [(i // step) * step / rate for i in range(count)]
+    elif profile == "poisson":
+        offsets = list(itertools.accumulate(random.expovariate(rate) for _ in range(count)))
+    else:
+        raise ValueError(f"Unknown ramp profile \"{profile}\"")
+
+    if jitter > 0:
+        offsets = [offset + random.uniform(0, jitter) for offset in offsets]
+    return offsets
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline: int, callback: Callable):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel shared by all devices of a worker.
+
+    Time is divided into ticks of `resolution` seconds. Level 0 has a slot
+    per tick of the current block of SLOTS ticks, every following level has
+    a slot per block of the level below it. Timers are stored in the lowest
+    level whose current block contains their deadline and move down a level
+    (cascade) when their block becomes the current one, so scheduling,
+    cancelling and firing a timer are all O(1) no matter how many timers
+    are pending.
+    """
+    SLOT_BITS = 8
+    SLOTS = 1 << SLOT_BITS
+    LEVELS = 4
+
+    def __init__(self, resolution: float = 0.01):
+        self.resolution = resolution
+        self.start = time.monotonic()
+        self.tick = 0
+        self.levels = [[[] for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self._lock = threading.Lock()
+
+    def schedule(self, when: float, callback: Callable) -> Timer:
+        """Calls `callback` from `advance` once the monotonic time `when` has passed."""
+        deadline = math.ceil((when - self.start) / self.resolution)
+        with self._lock:
+            timer = Timer(max(deadline, self.tick + 1), callback)
+            self._insert(timer)
+        return timer
+
+    def _insert(self, timer: Timer):
+        for level in range(self.LEVELS - 1):
+            block_bits = self.SLOT_BITS * (level + 1)
+            if timer.deadline >> block_bits == self.tick >> block_bits:
+                break
+        else:
+            level = self.LEVELS - 1
+        slot = (timer.deadline >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+        self.levels[level][slot].append(timer)
+
+    def _cascade(self):
+        for level in range(1, self.LEVELS):
+            if self.tick & ((1 << (self.SLOT_BITS * level)) - 1):
+                break
+        else:
+            level = self.LEVELS
+        # move timers of the blocks that just became current, top down
+        for level in range(level - 1, 0, -1):
+            slot = (self.tick >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+            timers, self.levels[level][slot] = self.levels[level][slot], []
+            for timer in timers:
+                if not timer.cancelled:
+                    self._insert(timer)
+
+    def advance(self, now: float = None) -> List[Callable]:
+        """Moves the wheel to `now` and returns callbacks of the expired timers."""
+        if now is None:
+            now = time.monotonic()
+        target = int((now - self.start) / self.resolution)
+        expired = []
+        with self._lock:
+            while self.tick < target:
+                self.tick += 1
+                self._cascade()
+                slot = self.tick & (self.SLOTS - 1)
+                timers, self.levels[0][slot] = self.levels[0][slot], []
+                expired.extend(timer.callback for timer in timers if not timer.cancelled)
+        return expired
+
+    def run(self, stop_event):
+        """Drives the wheel from the calling thread until `stop_event` is set."""
+        while not stop_event.wait(self.resolution):
+            for callback in self.advance():
+                try:
+                    callback()
+                except Exception as e:
+                    stats.count("errors")
+                    logger.error(f"timer callback failed: {e!r}")
+
+
+class Backoff:
+    """Capped exponential backoff; `jitter` randomly shortens every delay by up to that fraction."""
+    MAX_ATTEMPT = 64
+
+    def __init__(self, initial: float = 1.0, maximum: float = 60.0, jitter: float = 0.5, multiplier: float = 2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.multiplier = multiplier
+        self.attempt = 0
+
+    def next(self) -> float:
+        delay = min(self.maximum, self.initial * self.multiplier ** self.attempt)
+        self.attempt = min(self.attempt + 1, self.MAX_ATTEMPT)
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempt = 0
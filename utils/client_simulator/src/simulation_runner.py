@@ -1,11 +1,25 @@
 #!/usr/bin/env python3
-from .utils import get_msg_templates, Args
-from .log import logger
+from .utils import get_message_templates, Args
+from .scheduler import connect_offsets, TimerWheel, Backoff
+from .traffic import TrafficStream, default_traffic_mix, parse_traffic_mix
+from .distribution import Distribution, parse_distribution
+from .responder import CommandResponder, CommandReply, get_command_responder
+from .control import ControlBlock, start_control_server
+from .mac_store import get_mac_store
+from .source_address import get_source_addresses
+from .saturation import SaturationFinder
+from .trace import TraceReplay, load_sessions
+from .roaming import RoamingGroup
+from .log import logger, setup_logging, stop_logging
+from . import event_log
+from . import stats
 from websockets.sync import client
-from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError, ConnectionClosed
+from websockets.exceptions import ConnectionClosed, WebSocketException
 from websockets.frames import *
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, List, Tuple
 import multiprocessing
+import functools
 import socket
 import struct
 import threading
@@ -13,27 +27,85 @@ import resource
 import string
 import random
 import signal
-import copy
+import queue
+import math
 import time
 import json
 import ssl
 import os
-import re
+
+
+@functools.lru_cache(maxsize=8)
+def get_log_payload(size: int) -> str:
+    # one random payload per size, shared by all devices of a process
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=size))
+
+
+# rendered frames up to this size are kept by their device, larger ones are
+# rendered again for every send
+SMALL_FRAME_SIZE = 4096
 
 
 class Message:
+    """
+    Frames of a single device, rendered from the shared templates. Small
+    frames are kept once rendered. The state frame (~24 kB) and the log frame
+    (up to msg_size) are rendered by a single join for every send, so the
+    memory of a device does not grow with them: the log frame joins the
+    device's rendered head and tail with the payload shared by all devices
+    of the process.
+    """
+    __slots__ = ("mac", "size", "frames")
+
     def __init__(self, mac: str, size: int):
-        tmp_mac = copy.deepcopy(mac)
-        tmp_mac = tmp_mac.replace(":", "")
-        self.templates = get_msg_templates()
-        self.connect = json.dumps(self.templates["connect"]).replace("MAC", tmp_mac)
-        self.state = json.dumps(self.templates["state"]).replace("MAC", mac)
-        self.reboot_response = json.dumps(self.templates["reboot_response"]).replace("MAC", mac)
-        self.log = copy.deepcopy(self.templates["log"])
-        self.log["params"]["data"] = {"msg": ''.join(random.choices(string.ascii_uppercase + string.digits, k=size))}
-        self.log = json.dumps(self.log).replace("MAC", mac)
-        self.join = json.dumps(self.templates["join"]).replace("MAC", mac)
-        self.leave = json.dumps(self.templates["leave"]).replace("MAC", mac)
+        self.mac = mac
+        self.size = size
+        # small rendered frames by template name, see render
+        self.frames = {}
+
+    def render(self, name: str, mac: str = None) -> str:
+        frame = self.frames.get(name)
+        if frame is None:
+            frame = get_message_templates().render(name, mac or self.mac)
+            if len(frame) <= SMALL_FRAME_SIZE:
+                self.frames[name] = frame
+        return frame
+
+    @property
+    def connect(self) -> str:
+        return self.render("connect", self.mac.replace(":", ""))
+
+    @connect.setter
+    def connect(self, value: str):
+        # e.g. the connect message of a replayed session
+        self.frames["connect"] = value
+
+    @property
+    def state(self) -> str:
+        return self.render("state")
+
+    @property
+    def state_obf(self) -> str:
+        return self.render("state_obf")
+
+    @property
+    def reboot_response(self) -> str:
+        return self.render("reboot_response")
+
+    @property
+    def log(self) -> str:
+        ends = self.frames.get("log")
+        if ends is None:
+            ends = self.frames["log"] = get_message_templates().render_log_ends(self.mac)
+        return "".join((ends[0], get_log_payload(self.size), ends[1]))
+
+    @property
+    def join(self) -> str:
+        return self.render("join")
+
+    @property
+    def leave(self) -> str:
+        return self.render("leave")
 
     @staticmethod
     def to_json(msg) -> str:
@@ -44,53 +116,354 @@ class Message:
         return json.loads(msg)
 
 
+@functools.cache
+def get_ssl_context(client_cert: str, client_key: str, ca_cert: str, check_cert: bool) -> ssl.SSLContext:
+    # devices sharing the same certificates share a single context, so PEM
+    # files are parsed once per process instead of once per device
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.load_cert_chain(client_cert, client_key, "")
+    ssl_context.load_verify_locations(ca_cert)
+    if check_cert:
+        ssl_context.verify_mode = ssl.CERT_REQUIRED
+    else:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+
+# optional field of a downlink message's params with the (epoch) time at
+# which the message was issued, used to measure downlink latency
+DOWNLINK_TIMESTAMP_KEY = "issued_at"
+
+
+# payload of probe pings: the time the ping was sent, echoed back in the pong
+PING_PAYLOAD = struct.Struct("!d")
+
+
+class ProbingClientConnection(client.ClientConnection):
+    """
+    Records the round trip time of probe pings when their pong arrives. With
+    an inbox, received messages are put into it as (connection, message)
+    instead of being buffered for `recv`, followed by (connection, None) when
+    the connection ends, so a thread waiting on the inbox also learns of both.
+    """
+
+    def __init__(self, *args, inbox: queue.SimpleQueue = None, **kwargs):
+        # set before the base class starts the receiving thread
+        self.inbox = inbox
+        self.fragments = []
+        super().__init__(*args, **kwargs)
+
+    def process_event(self, event):
+        if self.inbox is None or not isinstance(event, Frame) or event.opcode not in DATA_OPCODES:
+            super().process_event(event)
+            return
+        self.fragments.append(event)
+        if event.fin:
+            data = b"".join(frame.data for frame in self.fragments)
+            if self.fragments[0].opcode is Opcode.TEXT:
+                data = data.decode(errors="replace")
+            self.fragments = []
+            self.inbox.put((self, data))
+
+    def close_socket(self):
+        super().close_socket()
+        if self.inbox is not None:
+            self.inbox.put((self, None))
+
+    def acknowledge_pings(self, data: bytes):
+        if len(data) == PING_PAYLOAD.size and data in self.ping_waiters:
+            stats.record("ping_rtt", time.perf_counter() - PING_PAYLOAD.unpack(data)[0])
+        super().acknowledge_pings(data)
+
+
+class ResumingSSLContext:
+    """
+    Wraps a shared SSL context so that new connections resume a previous TLS
+    session. Implements the subset of `ssl.SSLContext` used by
+    `socket`-based (wrap_socket) and asyncio (wrap_bio) connections.
+    """
+
+    def __init__(self, ssl_context: ssl.SSLContext, session: ssl.SSLSession):
+        self.ssl_context = ssl_context
+        self.session = session
+
+    def wrap_socket(self, sock, server_hostname=None, **kwargs):
+        return self.ssl_context.wrap_socket(sock, server_hostname=server_hostname,
+                                            session=self.session, **kwargs)
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, **kwargs):
+        return self.ssl_context.wrap_bio(incoming, outgoing, server_side=server_side,
+                                         server_hostname=server_hostname, session=self.session, **kwargs)
+
+
+# defaults of devices that are not configured, shared to keep devices small
+DEFAULT_RESPONDER = CommandResponder()
+DEFAULT_REBOOT_TIME = Distribution("const", [10])
+# states of a device that closed its connection on purpose and waits for
+# its wakeup timer
+OFFLINE_STATES = ("rebooting", "churning")
+# connections a worker of the thread engine closes at once on shutdown
+SHUTDOWN_THREADS = 128
+
+
+def closed_cleanly(connection) -> bool:
+    # both close frames were exchanged, the close handshake completed
+    protocol = connection.protocol
+    return protocol.close_rcvd is not None and protocol.close_sent is not None
+
+
 class Device:
+    __slots__ = ("mac", "interval", "messages", "server_addr", "start_event", "stop_event", "responder",
+                 "reboot_time", "wakeup", "_socket", "ssl_context", "tls_session_reuse", "tls_session",
+                 "start_delay", "connected_at", "connects", "state", "backoff", "lost_at", "wheel", "phase",
+                 "traffic", "traffic_timers", "index", "parked", "source_address", "ping_interval", "ping_timer",
+                 "replay", "session_lifetime", "churn_offline", "inbox")
+
     def __init__(self, mac: str, server: str, ca_cert: str,
                  msg_interval: int, msg_size: int,
                  client_cert: str, client_key: str, check_cert: bool,
                  start_event: multiprocessing.Event,
-                 stop_event: multiprocessing.Event):
+                 stop_event: multiprocessing.Event,
+                 tls_session_reuse: bool = False):
         self.mac = mac
         self.interval = msg_interval
         self.messages = Message(self.mac, msg_size)
         self.server_addr = server
         self.start_event = start_event
         self.stop_event = stop_event
-        self.reboot_time_s = 10
+        self.responder = DEFAULT_RESPONDER
+        self.reboot_time = DEFAULT_REBOOT_TIME
+        # set by a timer when the device is done rebooting
+        self.wakeup = threading.Event()
         self._socket = None
+        self.ssl_context = get_ssl_context(client_cert, client_key, ca_cert, check_cert)
+        self.tls_session_reuse = tls_session_reuse
+        self.tls_session = None
+        self.start_delay = 0
+        self.connected_at = None
+        self.connects = 0
+        self.state = "idle"
+        self.backoff = Backoff()
+        self.lost_at = None
+        self.wheel = None
+        self.phase = 0.0
+        self.traffic = default_traffic_mix(msg_interval)
+        # timers of the running traffic schedule, None while it is not running
+        self.traffic_timers = None
+        # position of the device among the devices of its MAC mask
+        self.index = 0
+        # parked devices stay disconnected until unparked, see ControlWatcher
+        self.parked = False
+        # (address, 0) the connection is bound to, None lets the OS choose
+        self.source_address = None
+        # seconds between probe pings, 0 if the device is not probed
+        self.ping_interval = 0
+        self.ping_timer = None
+        # replays a recorded session instead of sending the traffic streams
+        self.replay = None
+        # with churn, sessions are closed after a sampled lifetime and the
+        # device reconnects after a sampled offline time
+        self.session_lifetime = None
+        self.churn_offline = None
+        # work handed to the device's thread: timer callbacks and the
+        # messages of its connection, see process_inbox
+        self.inbox = None
+
+    def get_connect_ssl_context(self):
+        if self.tls_session_reuse and self.tls_session is not None:
+            return ResumingSSLContext(self.ssl_context, self.tls_session)
+        return self.ssl_context
+
+    def save_tls_session(self, ssl_object):
+        if not self.tls_session_reuse or ssl_object is None:
+            return
+        if ssl_object.session_reused:
+            logger.debug(f"{self.mac}: TLS session resumed")
+        self.tls_session = ssl_object.session
+
+    def record_connect_start(self) -> float:
+        event_log.log_event(self.mac, event_log.CONNECT_START)
+        return time.perf_counter()
+
+    def record_connect(self, start: float):
+        self.connected_at = time.perf_counter()
+        stats.record("wss_open", self.connected_at - start)
+        event_log.log_event(self.mac, event_log.CONNECT_END, self.connected_at - start)
+        stats.count("connects")
+        if self.connects > 0:
+            stats.count("reconnects")
+        if self.lost_at is not None:
+            stats.record("reconnect", self.connected_at - self.lost_at)
+            event_log.log_event(self.mac, event_log.RECONNECT, self.connected_at - self.lost_at)
+            self.lost_at = None
+        self.connects += 1
+
+    def record_connection_lost(self, error: Exception):
+        self.state = "backoff"
+        if self._socket is not None:
+            stats.count("connection_lost")
+            if self.lost_at is None:
+                self.lost_at = time.perf_counter()
+        else:
+            stats.count("connect_failures")
+            event_log.log_event(self.mac, event_log.CONNECT_FAILED, reason=event_log.failure_reason(error))
+        logger.warning(f"{self.mac}: connection to GW lost or failed: {error!r}")
+
+    def record_disconnect(self):
+        stats.count("disconnects")
+        reason = event_log.DISCONNECT_STATES["parked"] if self.parked else \
+            event_log.DISCONNECT_STATES.get(self.state, 0)
+        event_log.log_event(self.mac, event_log.DISCONNECT, reason=reason)
+
+    def record_sent(self, data):
+        stats.count("messages_sent")
+        stats.count("bytes_sent", len(data))
+
+    def record_received(self, msg: dict):
+        stats.count("messages_received")
+        if self.connected_at is not None:
+            elapsed = time.perf_counter() - self.connected_at
+            stats.record("first_message", elapsed)
+            event_log.log_event(self.mac, event_log.FIRST_MESSAGE, elapsed)
+            self.connected_at = None
+        latency = event_log.NO_VALUE
+        params = msg.get("params") if isinstance(msg, dict) else None
+        if isinstance(params, dict) and isinstance(params.get(DOWNLINK_TIMESTAMP_KEY), (int, float)):
+            # wall clock, the sender and the simulator are expected to be in sync
+            latency = time.time() - params[DOWNLINK_TIMESTAMP_KEY]
+            stats.record("downlink", latency)
+        event_log.log_event(self.mac, event_log.DOWNLINK, latency)
+
+    def next_send(self, period: float, now: float) -> float:
+        # sends are aligned to a grid of the stream's period shifted by the
+        # device's phase, so they neither drift nor synchronize
+        base = self.wheel.start + self.phase * period
+        return base + (math.floor((now - base) / period) + 1) * period
+
+    def schedule_stream(self, index: int, timers: list):
+        stream = self.traffic[index]
+        timers[index] = self.wheel.schedule(self.next_send(stream.period, time.monotonic()),
+                                            functools.partial(self.on_traffic, index, timers))
 
-        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        self.ssl_context.load_cert_chain(client_cert, client_key, "")
-        self.ssl_context.load_verify_locations(ca_cert)
-        if check_cert:
-            self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+    def schedule_ping(self, timers: list):
+        self.ping_timer = self.wheel.schedule(self.next_send(self.ping_interval, time.monotonic()),
+                                              functools.partial(self.on_ping, timers))
+
+    def schedule_replay(self, timers: list):
+        when, frame = self.replay.next_frame()
+        self.replay.timer = self.wheel.schedule(when, functools.partial(self.on_replay, frame, timers))
+
+    def schedule_traffic(self):
+        # every schedule gets a timer list of its own, which its callbacks
+        # keep; callbacks of a cancelled schedule, that may already have been
+        # taken off the wheel, find it replaced and stop
+        timers = [None] * len(self.traffic) if self.replay is None else []
+        self.traffic_timers = timers
+        if self.replay is not None:
+            self.replay.restart(time.monotonic())
+            self.schedule_replay(timers)
         else:
-            self.ssl_context.check_hostname = False
-            self.ssl_context.verify_mode = ssl.CERT_NONE
+            for index in range(len(timers)):
+                self.schedule_stream(index, timers)
+        if self.ping_interval > 0:
+            self.schedule_ping(timers)
+
+    def restart_traffic(self):
+        # called by a timer, so the schedule is replaced on the wheel's thread
+        if self.traffic_timers is not None:
+            self.cancel_traffic()
+            self.schedule_traffic()
+
+    def cancel_traffic(self):
+        timers, self.traffic_timers = self.traffic_timers, None
+        for timer in timers or ():
+            if timer is not None:
+                timer.cancel()
+        if self.ping_timer is not None:
+            self.ping_timer.cancel()
+            self.ping_timer = None
+        if self.replay is not None and self.replay.timer is not None:
+            self.replay.timer.cancel()
+            self.replay.timer = None
+
+    def on_replay(self, frame: str, timers: list):
+        if timers is not self.traffic_timers:
+            return  # cancelled
+        self.schedule_replay(timers)
+        self.post(self.replay.session.rewrite(frame, self.mac.replace(":", "")))
+
+    def post(self, frame: str):
+        """Sends a frame from a timer callback, frames of disconnected devices are dropped."""
+        if self._socket is not None:
+            self.deliver(functools.partial(self.send_posted, frame))
+
+    def send_posted(self, frame: str):
+        socket = self._socket
+        if socket is None:
+            return
+        try:
+            self.send(socket, frame)
+        except ConnectionClosed:
+            logger.debug(f"{self.mac}: connection closed, frame not sent")
+
+    def on_ping(self, timers: list):
+        if timers is not self.traffic_timers:
+            return  # cancelled
+        self.schedule_ping(timers)
+        socket = self._socket
+        if socket is not None:
+            self.deliver(functools.partial(self.send_ping, socket))
+
+    def on_traffic(self, index: int, timers: list):
+        if timers is not self.traffic_timers:
+            return  # cancelled
+        self.schedule_stream(index, timers)
+        self.deliver(functools.partial(self.send_traffic, self.traffic[index]))
+
+    def send_traffic(self, stream: TrafficStream):
+        socket = self._socket
+        if socket is None:
+            return
+        logger.debug(f"{self.mac}: sending {stream.burst} x {stream.types}")
+        try:
+            for _ in range(stream.burst):
+                self.send_message(socket, stream.pick())
+        except ConnectionClosed:
+            logger.warning(f"{self.mac}: connection closed, {stream.types} not sent")
+
+    def send(self, socket: client.ClientConnection, data: str):
+        socket.send(data)
+        self.record_sent(data)
+
+    def send_message(self, socket: client.ClientConnection, message_type: str):
+        self.send(socket, getattr(self.messages, message_type))
 
     def send_ping(self, socket: client.ClientConnection):
-        socket.ping()
+        # the round trip time is recorded by ProbingClientConnection
+        socket.ping(PING_PAYLOAD.pack(time.perf_counter()))
 
     def send_hello(self, socket: client.ClientConnection):
         logger.debug(self.messages.connect)
-        socket.send(self.messages.connect)
+        self.send(socket, self.messages.connect)
 
     def send_log(self, socket: client.ClientConnection):
-        socket.send(self.messages.log)
+        self.send(socket, self.messages.log)
 
     def send_state(self, socket: client.ClientConnection):
-        socket.send(self.messages.state)
+        self.send(socket, self.messages.state)
 
     def send_join(self, socket: client.ClientConnection):
-        socket.send(self.messages.join)
+        self.send(socket, self.messages.join)
 
     def send_leave(self, socket: client.ClientConnection):
-        socket.send(self.messages.leave)
+        self.send(socket, self.messages.leave)
 
     def get_single_message(self, socket: client.ClientConnection):
         try:
-            msg = socket.recv(self.interval)
-            return self.messages.from_json(msg)
+            msg = self.messages.from_json(socket.recv(self.interval))
+            self.record_received(msg)
+            return msg
         except TimeoutError:
             return None
         except:
@@ -99,42 +472,206 @@ class Device:
     def handle_messages(self, socket: client.ClientConnection):
         try:
             msg = socket.recv(self.interval)
-            msg = self.messages.from_json(msg)
-            logger.info(msg)
-            if msg["method"] == "reboot":
-                self.handle_reboot(socket, msg)
-            else:
-                logger.error(f"Unknown method {msg['method']}")
         except TimeoutError:  # no messages
-            pass
-        except (ConnectionClosedOK, ConnectionClosedError, ConnectionClosed):
-            logger.critical("Did not expect socket to be closed")
-            raise
+            return
+        self.handle_message(socket, msg)
 
-    def handle_reboot(self, socket: client.ClientConnection, msg: dict):
-        resp = self.messages.from_json(self.messages.reboot_response)
-        if "id" in msg:
-            resp["result"]["id"] = msg["id"]
+    def parse_message(self, data) -> dict:
+        """Returns the JSON object of a received message, None for anything else."""
+        try:
+            msg = self.messages.from_json(data)
+        except (ValueError, TypeError) as e:
+            logger.error(f"{self.mac}: received a message that is not JSON: {e!r}")
+            return None
+        if not isinstance(msg, dict):
+            logger.error(f"{self.mac}: received a message that is not a JSON object")
+            return None
+        return msg
+
+    def handle_message(self, socket: client.ClientConnection, msg: str):
+        msg = self.parse_message(msg)
+        if msg is None:
+            return
+        self.record_received(msg)
+        logger.info(msg)
+        if "method" in msg:
+            self.handle_command(socket, msg)
         else:
-            del resp["result"]["id"]
-            logger.warn("Reboot request is missing 'id' field")
-        socket.send(self.messages.to_json(resp))
-        self.disconnect()
-        time.sleep(self.reboot_time_s)
-        self.connect()
-        self.send_hello(self._socket)
+            logger.error(f"{self.mac}: received a message without method")
+
+    def deliver(self, callback: Callable):
+        """
+        Hands the blocking part of a timer callback to the device's thread,
+        the timer wheel thread only keeps time. Dropped before the device
+        started.
+        """
+        inbox = self.inbox
+        if inbox is not None:
+            inbox.put(callback)
+
+    def wake(self):
+        self.wakeup.set()
+        # the device's thread waits on its inbox
+        self.deliver(None)
+
+    def process_inbox(self, timeout: float = None):
+        """Handles the next message or callback handed to the device, waits up to `timeout` for one."""
+        try:
+            item = self.inbox.get(timeout=timeout)
+        except queue.Empty:
+            return
+        if item is None:  # woken up
+            return
+        if not isinstance(item, tuple):
+            try:
+                item()
+            except ConnectionClosed:
+                pass  # the end of the connection follows in the inbox
+            except Exception as e:
+                logger.error(f"{self.mac}: timer callback failed: {e!r}")
+            return
+        connection, msg = item
+        if connection is not self._socket:
+            return  # left over from a previous connection
+        if msg is None:
+            raise connection.protocol.close_exc
+        self.handle_message(connection, msg)
+
+    def idle(self, until: Callable[[], bool] = None, timeout: float = None):
+        """Processes the inbox until `until()` holds, `timeout` passed or the simulation stops."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while (until is None or not until()) and not self.stop_event.is_set():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+            self.process_inbox(remaining)
+
+    def command_reply(self, msg: dict) -> CommandReply:
+        if "id" not in msg:
+            logger.warning(f"{msg.get('method')} request is missing 'id' field")
+        # the reboot response template is the generic command result
+        return self.responder.reply(msg, self.messages.from_json(self.messages.reboot_response))
+
+    def record_command(self, reply: CommandReply):
+        stats.count("commands")
+        if reply.error:
+            stats.count("command_errors")
+        event_log.log_event(self.mac, event_log.RESPONSE, reply.delay, int(reply.error))
+
+    def go_offline(self, state: str, duration: float):
+        # the session ends and the device reconnects once the wakeup timer
+        # fires, nothing waits for it in the meantime
+        self.state = state
+        self.wakeup.clear()
+        self.wheel.schedule(time.monotonic() + duration, self.wake)
+        if self.stop_event.is_set():
+            # timers may not fire anymore, see run_timers
+            self.wake()
+
+    def start_reboot(self):
+        duration = self.reboot_time.sample()
+        self.go_offline("rebooting", duration)
+        stats.count("reboots")
+        logger.debug(f"{self.mac}: rebooting for {duration:.1f}s")
+
+    def schedule_session_end(self):
+        if self.session_lifetime is None:
+            return
+        lifetime = self.session_lifetime.sample()
+        if self.connects == 1:
+            # devices connect at about the same time, their first sessions
+            # are shortened randomly so that they do not churn together
+            lifetime *= random.random()
+        self.wheel.schedule(time.monotonic() + lifetime, functools.partial(self.on_session_end, self._socket))
+
+    def on_session_end(self, socket: client.ClientConnection):
+        if socket is not self._socket or self.state != "connected":
+            return
+        self.end_session()
+        # closing waits for the server, that is up to the device's thread
+        self.deliver(self.disconnect)
+
+    def end_session(self):
+        duration = self.churn_offline.sample()
+        self.go_offline("churning", duration)
+        stats.count("churns")
+        logger.debug(f"{self.mac}: churning, offline for {duration:.1f}s")
+
+    def handle_command(self, socket: client.ClientConnection, msg: dict):
+        reply = self.command_reply(msg)
+        if reply.delay > 0:
+            # the device keeps receiving until the timer hands the reply back
+            self.wheel.schedule(time.monotonic() + reply.delay,
+                                functools.partial(self.on_command_done, socket, reply))
+        else:
+            self.finish_command(socket, reply)
+
+    def on_command_done(self, socket: client.ClientConnection, reply: CommandReply):
+        self.deliver(functools.partial(self.send_delayed_reply, socket, reply))
+
+    def send_delayed_reply(self, socket: client.ClientConnection, reply: CommandReply):
+        if socket is not self._socket:
+            logger.warning(f"{self.mac}: connection closed, {reply.method} reply not sent")
+            return
+        self.finish_command(socket, reply)
+
+    def finish_command(self, socket: client.ClientConnection, reply: CommandReply):
+        self.send(socket, self.messages.to_json(reply.result))
+        self.record_command(reply)
+        if reply.reboot:
+            # state first, the receive loop then knows the connection
+            # was closed on purpose
+            self.start_reboot()
+            self.disconnect()
 
     def connect(self):
         if self._socket is None:
             # 20 seconds is more then enough to establish conne and exchange
             # them handshakes.
-            self._socket = client.connect(self.server_addr, ssl=self.ssl_context, open_timeout=20, close_timeout=20)
+            start = self.record_connect_start()
+            self._socket = client.connect(self.server_addr, ssl=self.get_connect_ssl_context(),
+                                          open_timeout=20, close_timeout=20,
+                                          source_address=self.source_address,
+                                          create_connection=functools.partial(ProbingClientConnection,
+                                                                              inbox=self.inbox))
+            self.record_connect(start)
         return self._socket
 
     def disconnect(self):
         if self._socket is not None:
-            self._socket.close()
-            self._socket = None
+            socket, self._socket = self._socket, None
+            if isinstance(socket.socket, ssl.SSLSocket):
+                self.save_tls_session(socket.socket)
+            socket.close()
+            self.record_disconnect()
+
+    def shutdown(self, timeout: float) -> bool:
+        """Closes the connection within `timeout`, returns whether it closed cleanly (None without one)."""
+        socket = self._socket
+        if socket is None:
+            return None
+        self.state = "stopped"
+        socket.close_timeout = max(0.0, timeout)
+        self.disconnect()
+        return closed_cleanly(socket)
+
+    def park(self):
+        # the device closes its connection itself, not the caller's thread
+        self.parked = True
+        self.deliver(self.disconnect)
+
+    def unpark(self):
+        self.parked = False
+        self.wake()
+
+    def drop(self):
+        # abort the connection without a close handshake, as if the
+        # network failed; the device reconnects like after any other loss
+        connection = self._socket
+        if connection is not None:
+            connection.socket.shutdown(socket.SHUT_RDWR)
 
     def single_run(self):
         logger.debug("starting simulation")
@@ -156,42 +693,92 @@ class Device:
             self.disconnect()
         logger.debug("simulation done")
 
+    def run_session(self):
+        self.state = "connecting"
+        self.connect()
+        self.send_hello(self._socket)
+        self.state = "connected"
+        self.backoff.reset()
+        self.schedule_session_end()
+        while self.state == "connected" and not self.parked and not self.stop_event.is_set():
+            self.process_inbox(self.interval)
+
     def job(self):
         logger.debug("waiting for start trigger")
         self.start_event.wait()
+        if self.start_delay > 0:
+            self.stop_event.wait(self.start_delay)
         if self.stop_event.is_set():
             return
         logger.debug("starting simulation")
-        self.connect()
-        start = time.time()
+        # the worker's timer wheel thread only keeps time, the sends of the
+        # device's timers are made by this thread between its messages
+        self.inbox = queue.SimpleQueue()
+        self.schedule_traffic()
         try:
-            self.send_hello(self._socket)
             while not self.stop_event.is_set():
-                if self._socket is None:
-                    logger.error("Connection to GW is lost. Trying to reconnect...")
-                    self.connect()
-                if time.time() - start > self.interval:
-                    logger.info(f"Device sim heartbeat")
-                    self.send_state(self._socket)
-                    self.send_log(self._socket)
-                    start = time.time()
-                self.handle_messages(self._socket)
+                if self.parked:
+                    # parked while connecting
+                    self.disconnect()
+                    self.state = "parked"
+                    self.idle(lambda: not self.parked)
+                    # unparked devices connect on the ramp of the scale up, see ControlWatcher
+                    self.idle(lambda: self.parked, timeout=self.start_delay)
+                    continue
+                try:
+                    self.run_session()
+                except (WebSocketException, OSError, EOFError) as e:
+                    if self.state not in OFFLINE_STATES and not self.parked and not self.stop_event.is_set():
+                        self.record_connection_lost(e)
+                        self.disconnect()
+                        self.idle(timeout=self.backoff.next())
+                if self.state in OFFLINE_STATES:
+                    self.idle(self.wakeup.is_set)
+        except Exception:
+            stats.count("errors")
+            raise
         finally:
-            self.disconnect()
+            self.state = "stopped"
+            self.cancel_traffic()
+            if not self.stop_event.is_set():
+                # on stop, connections are closed by shutdown_devices, within its deadline
+                self.disconnect()
         logger.debug("simulation done")
 
 
-def get_avail_mac_addrs(path, mask="XX:XX:XX:XX:XX:XX"):
-    mask = mask.upper()
-    _mask = "".join(("[0-9a-fA-F]" if c == "X" else c) for c in mask)
-    macs = open(path + '/macs.txt', 'r').read().split()
-    macs = list(macs)
-    new_macs = list()
-    for mac in macs:
-        if re.match(_mask, mac):
-            new_macs.append(mac)
+def get_avail_mac_addrs(path, mask="XX:XX:XX:XX:XX:XX", count: int = None):
+    return get_mac_store(path).select(mask, count)
+
+
+def get_worker_macs(args: Args, worker: int, workers: int) -> List[Tuple[int, str]]:
+    """
+    Returns the MACs of a worker with their index within their mask. The
+    devices of every mask are dealt to the workers round-robin, so workers
+    get the same number of devices, also of those connected initially.
+    Roaming groups are dealt as a whole, their clients roam between the
+    devices of a single worker.
+    """
+    block = args.roaming_group_size if args.roaming_clients > 0 else 1
+    macs = []
+    for mask in args.masks:
+        selected = get_avail_mac_addrs(args.cert_path, mask, args.max_connections)
+        if len(selected) < args.max_connections:
+            logger.warning(f"expected {args.max_connections} certificates, but only found {len(selected)} "
+                           f"({mask = })")
+        indexed = list(enumerate(selected))
+        for start in range(worker * block, len(indexed), workers * block):
+            macs.extend(indexed[start:start + block])
+    return macs
+
+
+def pin_to_cpu(worker: int):
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    cpus = sorted(os.sched_getaffinity(0))
+    cpu = cpus[worker % len(cpus)]
+    os.sched_setaffinity(0, {cpu})
+    logger.debug(f"pinned to CPU {cpu}")
 
-    return new_macs
 
 def update_fd_limit():
     soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
@@ -204,32 +791,324 @@ def update_fd_limit():
     logger.warning(f"changed fd limit {soft, hard}")
 
 
-def process(args: Args, mask: str, start_event: multiprocessing.Event, stop_event: multiprocessing.Event):
+def ramp_connects(args: Args, devices: List[Device]):
+    """Sets the start delays of devices about to connect, so they connect at the ramp's rate."""
+    # the connect rate is shared by all processes
+    rate = args.connect_rate / args.workers
+    offsets = connect_offsets(len(devices), rate, args.ramp_profile, args.ramp_step, args.ramp_jitter)
+    for device, offset in zip(devices, offsets):
+        device.start_delay = offset
+    if rate > 0 and devices:
+        logger.info(f"connecting {len(devices)} devices over {max(offsets):.1f}s "
+                    f"({args.ramp_profile} profile, {rate:g}/s)")
+
+
+def schedule_connects(args: Args, devices: List[Device]):
+    for device in devices:
+        device.backoff = Backoff(args.reconnect_delay, args.reconnect_max_delay, args.reconnect_jitter)
+        # devices above the initial count wait until the simulation is scaled up
+        device.parked = device.index >= args.number_of_connections
+    # parked devices do not hold up the ramp, they get a delay once unparked
+    ramp_connects(args, [device for device in devices if not device.parked])
+
+
+def bind_source_addresses(args: Args, devices: List[Device], worker: int):
+    pool = get_source_addresses(args.source_addresses)
+    if pool is None:
+        return
+    # round-robin over the devices of all workers, so every address gets the
+    # same number of connections
+    for i, device in enumerate(devices):
+        device.source_address = (pool.address(i * args.workers + worker), 0)
+
+
+def configure_commands(args: Args, devices: List[Device]):
+    responder = get_command_responder(args.command_replies)
+    reboot_time = parse_distribution(args.reboot_time)
+    for device in devices:
+        device.responder = responder
+        device.reboot_time = reboot_time
+
+
+def configure_pings(args: Args, devices: List[Device]):
+    if args.ping_sample <= 0:
+        return
+    probed = 0
+    for device in devices:
+        if random.random() < args.ping_sample:
+            device.ping_interval = args.ping_interval
+            probed += 1
+    logger.info(f"probing {probed} of {len(devices)} connections every {args.ping_interval:g}s")
+
+
+def configure_replay(args: Args, devices: List[Device], worker: int):
+    if not args.trace:
+        return
+    sessions = load_sessions(args.trace)
+    if not sessions:
+        raise ValueError(f"{args.trace} has no sessions with uplink traffic")
+    # like the traffic phase, sessions are dealt to the devices of all workers
+    for i, device in enumerate(devices):
+        session = sessions[(i * args.workers + worker) % len(sessions)]
+        device.replay = TraceReplay(session, args.trace_speed)
+        if session.connect is not None:
+            device.messages.connect = session.rewrite(session.connect, device.mac.replace(":", ""))
+    logger.info(f"replaying {len(sessions)} recorded sessions at {args.trace_speed:g}x")
+
+
+def configure_roaming(args: Args, devices: List[Device], wheel: TimerWheel):
+    if args.roaming_clients <= 0:
+        return
+    dwell = parse_distribution(args.roaming_dwell)
+    away = parse_distribution(args.roaming_away)
+    # groups are runs of roaming_group_size devices of a mask, see get_worker_macs
+    groups = []
+    previous = None
+    for device in devices:
+        if previous is None or device.index <= previous.index or \
+                device.index // args.roaming_group_size != previous.index // args.roaming_group_size:
+            groups.append([])
+        groups[-1].append(device)
+        previous = device
+    for aps in groups:
+        RoamingGroup(aps, args.roaming_clients, wheel, dwell, away, args.roaming_ratio).start()
+    logger.info(f"{len(groups) * args.roaming_clients} wireless clients roaming between the APs of "
+                f"{len(groups)} groups (dwell {dwell}, away {away})")
+
+
+def configure_churn(args: Args, devices: List[Device]):
+    if not args.session_lifetime and not args.churn_rate:
+        return
+    offline = parse_distribution(args.churn_offline)
+    if args.session_lifetime:
+        lifetime = parse_distribution(args.session_lifetime)
+    else:
+        # every device churns once per session and offline time on average
+        devices_total = args.number_of_connections * len(args.masks)
+        lifetime = Distribution("exp", [max(0.0, devices_total / args.churn_rate - offline.mean())])
+    for device in devices:
+        device.session_lifetime = lifetime
+        device.churn_offline = offline
+    rate = len(devices) / max(lifetime.mean() + offline.mean(), 1e-9)
+    logger.info(f"churning: sessions last {lifetime}, devices stay offline {offline}, "
+                f"~{rate:.1f} churns/s in this process")
+
+
+def get_traffic(args: Args, interval: float) -> List[TrafficStream]:
+    if args.traffic_mix:
+        # explicit rates of the mix change with the message interval, so
+        # e.g. a saturation rate step raises all of the traffic
+        return parse_traffic_mix(args.traffic_mix, interval, interval / args.msg_interval)
+    return default_traffic_mix(interval)
+
+
+def spread_phases(devices: List[Device], active: int, workers: int, worker: int):
+    """
+    Spreads the messages of the `active` devices per mask of all processes
+    evenly over time; parked devices get their phase once unparked.
+    """
+    running = [device for device in devices if device.index < active]
+    for i, device in enumerate(running):
+        device.phase = (i * workers + worker) / (len(running) * workers)
+
+
+def schedule_traffic(args: Args, devices: List[Device], wheel: TimerWheel, worker: int):
+    traffic = get_traffic(args, args.msg_interval)
+    for device in devices:
+        device.wheel = wheel
+        device.traffic = traffic
+    spread_phases(devices, args.number_of_connections, args.workers, worker)
+
+
+def record_shutdown(results: list, elapsed: float):
+    closed = sum(result is not None for result in results)
+    clean = sum(result is True for result in results)
+    stats.count("shutdown_closes", closed)
+    stats.count("shutdown_clean_closes", clean)
+    logger.info(f"closed {closed} connections in {elapsed:.2f}s, {clean} of them cleanly")
+
+
+def shutdown_devices(devices: List[Device], timeout: float):
+    """
+    Closes the connections of all devices in parallel. Every close gets the
+    time left until the deadline, connections that do not complete the close
+    handshake by then are aborted.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    connected = [(device, device._socket) for device in devices]
+    connected = [(device, connection) for device, connection in connected if connection is not None]
+    if not connected:
+        return
+    pool = ThreadPoolExecutor(min(SHUTDOWN_THREADS, len(connected)), thread_name_prefix="shutdown")
+    futures = [pool.submit(lambda device: device.shutdown(deadline - time.monotonic()), device)
+               for device, _ in connected]
+    done, _ = wait(futures, max(0.0, deadline - time.monotonic()))
+    results = []
+    for future, (_, connection) in zip(futures, connected):
+        if future in done and future.exception() is None:
+            results.append(future.result())
+            continue
+        # a close still waiting, e.g. for a send stuck on a peer that stopped
+        # reading, or not even started; shutting the socket down fails both
+        try:
+            connection.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        results.append(False)
+    pool.shutdown(wait=False, cancel_futures=True)
+    record_shutdown(results, time.monotonic() - start)
+
+
+def run_timers(wheel: TimerWheel, devices: List[Device], stop_event: multiprocessing.Event):
+    wheel.run(stop_event)
+    # timers do not fire anymore, wake up devices that wait for one
+    for device in devices:
+        device.wake()
+
+
+CONTROL_POLL_INTERVAL_S = 0.5
+
+
+class ControlWatcher:
+    """Applies changes of the control block to the devices of a worker."""
+
+    def __init__(self, args: Args, control: ControlBlock, devices: List[Device], worker: int = 0):
+        self.args = args
+        self.control = control
+        self.devices = devices
+        self.worker = worker
+        # devices per mask
+        self.active = args.number_of_connections
+        self.msg_interval = args.msg_interval
+        self.msg_size = args.msg_size
+        self.disconnect_seq = 0
+
+    def poll(self):
+        active = self.control.devices.value
+        if active != self.active:
+            logger.info(f"scaling from {self.active} to {active} devices per mask")
+            unparked = []
+            for device in self.devices:
+                if active <= device.index < self.active:
+                    device.park()
+                elif self.active <= device.index < active:
+                    unparked.append(device)
+            ramp_connects(self.args, unparked)
+            for device in unparked:
+                device.unpark()
+            self.active = active
+            # messages of the devices now running are spread over the interval
+            spread_phases(self.devices, active, self.args.workers, self.worker)
+            self.restart_traffic()
+
+        interval = self.control.msg_interval.value
+        if interval != self.msg_interval:
+            logger.info(f"changing message interval to {interval:g}s")
+            traffic = get_traffic(self.args, interval)
+            for device in self.devices:
+                device.interval = interval
+                device.traffic = traffic
+            self.restart_traffic()
+            self.msg_interval = interval
+
+        size = self.control.msg_size.value
+        if size != self.msg_size:
+            logger.info(f"changing message size to {size}")
+            for device in self.devices:
+                device.messages.size = size
+            self.msg_size = size
+
+        seq = self.control.disconnect_seq.value
+        if seq != self.disconnect_seq:
+            ratio = self.control.disconnect_ratio.value
+            dropped = [device for device in self.devices
+                       if device.index < self.active and random.random() < ratio]
+            logger.info(f"dropping {len(dropped)} connections")
+            for device in dropped:
+                device.drop()
+            self.disconnect_seq = seq
+
+    def restart_traffic(self):
+        for device in self.devices:
+            # on the wheel, where the timers of the old schedule fire
+            device.wheel.schedule(0, device.restart_traffic)
+
+    def run(self, stop_event: multiprocessing.Event):
+        while not stop_event.wait(CONTROL_POLL_INTERVAL_S):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"applying control changes failed: {e!r}")
+
+
+def process(args: Args, name: str, start_event: multiprocessing.Event, stop_event: multiprocessing.Event,
+            stats_queue: multiprocessing.Queue = None, counters: stats.Counters = None, worker: int = 0,
+            control: ControlBlock = None, histograms: stats.SharedHistograms = None):
     signal.signal(signal.SIGINT, signal.SIG_IGN)  # ignore Ctrl+C in child processes
-    threading.current_thread().name = mask
+    setup_logging(args.log_rate, args.log_samples, args.log_file)
+    threading.current_thread().name = name
+    if counters is not None:
+        stats.attach_counters(counters, worker)
+    if histograms is not None:
+        stats.attach_histograms(histograms, worker)
+    if args.event_log:
+        event_log.attach_event_log(args.event_log, worker)
+    if args.pin_cpus:
+        pin_to_cpu(worker)
     logger.info(f"process started")
-    macs = get_avail_mac_addrs(args.cert_path, mask)
-    if len(macs) < args.number_of_connections:
-        logger.warn(f"expected {args.number_of_connections} certificates, but only found {len(macs)} "
-                    f"({mask = })")
+    macs = get_worker_macs(args, worker, args.workers)
     update_fd_limit()
 
     devices = [Device(mac, args.server, args.ca_path, args.msg_interval, args.msg_size,
                       os.path.join(args.cert_path, f"base.crt"),
                       os.path.join(args.cert_path, f"base.key"),
                       args.check_cert,
-                      start_event, stop_event)
-               for mac, _ in zip(macs, range(args.number_of_connections))]
-    threads = [threading.Thread(target=d.job, name=d.mac) for d in devices]
+                      start_event, stop_event,
+                      args.tls_session_reuse)
+               for _, mac in macs]
+    for device, (index, _) in zip(devices, macs):
+        device.index = index
+    schedule_connects(args, devices)
+    bind_source_addresses(args, devices, worker)
+    configure_commands(args, devices)
+    configure_pings(args, devices)
+    configure_replay(args, devices, worker)
+    configure_churn(args, devices)
+    wheel = TimerWheel()
+    schedule_traffic(args, devices, wheel, worker)
+    configure_roaming(args, devices, wheel)
+    wheel_thread = threading.Thread(target=run_timers, args=(wheel, devices, stop_event), name=f"{name}-timers",
+                                    daemon=True)
+    # daemons, a device still connecting at the shutdown deadline does not
+    # keep the process alive
+    threads = [threading.Thread(target=d.job, name=d.mac, daemon=True) for d in devices]
     [t.start() for t in threads]
-    [t.join() for t in threads]
+    wheel_thread.start()
+    if control is not None:
+        watcher = ControlWatcher(args, control, devices, worker)
+        threading.Thread(target=watcher.run, args=(stop_event,), name=f"{name}-control", daemon=True).start()
+    stop_event.wait()
+    # devices blocked receiving are woken up by closing their connections
+    deadline = time.monotonic() + args.shutdown_timeout
+    shutdown_devices(devices, args.shutdown_timeout)
+    for t in threads:
+        t.join(max(0.0, deadline - time.monotonic()))
+    running = sum(t.is_alive() for t in threads)
+    if running:
+        logger.warning(f"{running} devices did not stop within {args.shutdown_timeout:g}s")
+    if stats_queue is not None:
+        stats_queue.put(stats.histograms)
+    event_log.close_event_log()
+    stop_logging()
 
 
 def verify_cert_availability(cert_path: str, masks: List[str], count: int):
+    store = get_mac_store(cert_path)
     for mask in masks:
-        macs = get_avail_mac_addrs(cert_path, mask)
-        assert len(macs) >= count, \
-            f"Simulation requires {count} certificates, but only found {len(macs)}"
+        found = store.count_matches(mask)
+        assert found >= count, \
+            f"Simulation requires {count} certificates, but only found {found}"
 
 
 def trigger_start(evt):
@@ -239,15 +1118,55 @@ def trigger_start(evt):
     return fn
 
 
-def main(args: Args):
-    verify_cert_availability(args.cert_path, args.masks, args.number_of_connections)
+def collect_histograms(processes: List[multiprocessing.Process], stats_queue: multiprocessing.Queue):
+    histograms = {}
+    pending = len(processes)
+    while pending > 0:
+        try:
+            stats.merge_histograms(histograms, stats_queue.get(timeout=1))
+            pending -= 1
+        except queue.Empty:
+            if not any(p.is_alive() for p in processes):
+                logger.error(f"{pending} processes exited without reporting latencies")
+                break
+    return histograms
+
+
+def report_histograms(args: Args, histograms: dict):
+    for line in stats.format_histograms(histograms):
+        logger.info(line)
+    if args.latency_report:
+        stats.dump_histograms(histograms, args.latency_report)
+        logger.info(f"latency report written to {args.latency_report}")
+
+
+def main(args: Args, target: Callable = process):
+    setup_logging(args.log_rate, args.log_samples, args.log_file)
+    verify_cert_availability(args.cert_path, args.masks, args.max_connections)
+    source_addresses = get_source_addresses(args.source_addresses)
+    if source_addresses is not None:
+        logger.info(f"binding connections to {len(source_addresses)} source addresses")
     stop_event = multiprocessing.Event()
     start_event = multiprocessing.Event()
     if not args.wait_for_sig:
         start_event.set()
+    stats_queue = multiprocessing.Queue()
+    counters = stats.Counters(args.workers)
+    histograms = stats.SharedHistograms(args.workers)
+    control = ControlBlock(args)
+    stop_requested = threading.Event()
     signal.signal(signal.SIGUSR1, trigger_start(start_event))
-    processes = [multiprocessing.Process(target=process, args=(args, mask, start_event, stop_event))
-                 for mask in args.masks]
+    processes = [multiprocessing.Process(target=target,
+                                         args=(args, f"worker-{worker}", start_event, stop_event, stats_queue,
+                                               counters, worker, control, histograms))
+                 for worker in range(args.workers)]
+    sampler = stats.CounterSampler(counters, args.counters_file)
+    if args.control:
+        start_control_server(args.control, control, counters, start_event, stop_requested)
+    if args.saturate:
+        finder = SaturationFinder(args, control, counters, histograms)
+        threading.Thread(target=finder.run, args=(start_event, stop_requested), name="saturation",
+                         daemon=True).start()
     try:
         for p in processes:
             p.start()
@@ -255,10 +1174,20 @@ def main(args: Args):
         logger.info(f"Started {len(processes)} processes")
         if args.wait_for_sig:
             logger.info("Waiting for SIGUSR1...")
-        while True:
-            time.sleep(100)
+        while not stop_requested.wait(1):
+            logger.info(sampler.sample())
     except KeyboardInterrupt:
-        logger.warn("Stopping all processes...")
-        stop_event.set()
-        start_event.set()
-        [p.join() for p in processes]
+        pass
+    logger.warn("Stopping all processes...")
+    stopping = time.monotonic()
+    stop_event.set()
+    start_event.set()
+    histograms = collect_histograms(processes, stats_queue)
+    [p.join() for p in processes]
+    logger.info(sampler.sample())
+    totals = counters.totals()
+    logger.info(f"stopped in {time.monotonic() - stopping:.1f}s, {totals['shutdown_clean_closes']} of "
+                f"{totals['shutdown_closes']} connections closed cleanly")
+    sampler.close()
+    report_histograms(args, histograms)
+    stop_logging()
@@ -0,0 +1,52 @@
+from typing import List, Tuple
+import ipaddress
+
+
+class SourceAddressPool:
+    """
+    Local addresses devices bind their connections to. Every address has its
+    own range of ephemeral ports, so N addresses allow about N times as many
+    connections to a single CGW port. Networks are not expanded, address i
+    is computed on lookup, so e.g. all of 127.0.0.0/8 costs nothing.
+    """
+
+    def __init__(self, networks: List[Tuple[ipaddress._BaseAddress, int]]):
+        # (first address, number of addresses)
+        self.networks = networks
+        self.size = sum(count for _, count in networks)
+
+    def __len__(self):
+        return self.size
+
+    def address(self, index: int) -> str:
+        index %= self.size
+        for first, count in self.networks:
+            if index < count:
+                return str(first + index)
+            index -= count
+        raise AssertionError("unreachable")
+
+
+def parse_source_address(spec: str) -> Tuple[ipaddress._BaseAddress, int]:
+    """
+    Parses an address (10.0.0.5), a network (127.0.0.0/8, without its network
+    and broadcast address) or a range (10.0.0.5-10.0.0.20).
+    """
+    try:
+        if "-" in spec:
+            first, last = (ipaddress.ip_address(part.strip()) for part in spec.split("-", 1))
+            if first.version != last.version or last < first:
+                raise ValueError(f"{last} is not after {first}")
+            return first, int(last) - int(first) + 1
+        network = ipaddress.ip_network(spec.strip(), strict=False)
+    except ValueError as e:
+        raise ValueError(f"Unable to parse source address \"{spec}\": {e}") from None
+    if network.num_addresses > 2:
+        return network.network_address + 1, network.num_addresses - 2
+    return network.network_address, network.num_addresses
+
+
+def get_source_addresses(specs: List[str]) -> SourceAddressPool:
+    if not specs:
+        return None
+    return SourceAddressPool([parse_source_address(spec) for spec in specs])
@@ -0,0 +1,317 @@
+from typing import Dict, List
+import multiprocessing
+import threading
+import ctypes
+import json
+import time
+
+
+class Histogram:
+    """
+    Log-linear (HDR style) latency histogram.
+
+    Values are recorded in microseconds. Values below 2 * SUB_BUCKETS are
+    counted exactly, larger values fall into one of SUB_BUCKETS buckets per
+    power of two, which keeps the relative error below 1 / SUB_BUCKETS while
+    the whole histogram stays a few KB in size no matter how many values are
+    recorded. Histograms of different processes can be merged.
+    """
+    SUB_BUCKET_BITS = 6
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def bucket_index(cls, value: int) -> int:
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS - 1
+        if shift <= 0:
+            return value
+        return (shift << cls.SUB_BUCKET_BITS) + (value >> shift)
+
+    @classmethod
+    def bucket_value(cls, index: int) -> int:
+        shift = (index >> cls.SUB_BUCKET_BITS) - 1
+        if shift <= 0:
+            return index
+        sub_bucket = index - (shift << cls.SUB_BUCKET_BITS)
+        # middle of the bucket
+        return (sub_bucket << shift) + (1 << (shift - 1))
+
+    def record(self, seconds: float):
+        value = max(0, int(seconds * 1_000_000))
+        index = self.bucket_index(value)
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.total += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def merge(self, other: "Histogram"):
+        with self._lock:
+            for index, count in other.counts.items():
+                self.counts[index] = self.counts.get(index, 0) + count
+            self.total += other.total
+            self.sum += other.sum
+            if other.min is not None and (self.min is None or other.min < self.min):
+                self.min = other.min
+            if other.max is not None and (self.max is None or other.max > self.max):
+                self.max = other.max
+
+    def percentiles(self, percentiles: List[float]) -> List[float]:
+        """Returns the requested percentiles in seconds."""
+        if self.total == 0:
+            return [0.0] * len(percentiles)
+        with self._lock:
+            buckets = sorted(self.counts.items())
+        result = []
+        for percentile in percentiles:
+            target = max(1, percentile / 100 * self.total)
+            seen = 0
+            for index, count in buckets:
+                seen += count
+                if seen >= target:
+                    break
+            value = min(max(self.bucket_value(index), self.min), self.max)
+            result.append(value / 1_000_000)
+        return result
+
+    def percentile(self, percentile: float) -> float:
+        return self.percentiles([percentile])[0]
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.total / 1_000_000 if self.total else 0.0
+
+    @classmethod
+    def from_buckets(cls, buckets: List[int]) -> "Histogram":
+        """Histogram of bucket counts (index -> count); min, max and sum are bucket estimates."""
+        histogram = cls()
+        for index, count in enumerate(buckets):
+            if count <= 0:
+                continue
+            value = cls.bucket_value(index)
+            histogram.counts[index] = count
+            histogram.total += count
+            histogram.sum += value * count
+            if histogram.min is None:
+                histogram.min = value
+            histogram.max = value
+        return histogram
+
+
+REPORT_PERCENTILES = [50, 90, 99, 99.9]
+
+# all devices of a process record into the same set of histograms
+histograms: Dict[str, Histogram] = {}
+_histograms_lock = threading.Lock()
+
+
+def get_histogram(name: str) -> Histogram:
+    histogram = histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = histograms.setdefault(name, Histogram())
+    return histogram
+
+
+def record(name: str, seconds: float):
+    get_histogram(name).record(seconds)
+    shared = _shared_histograms
+    if shared is None or name not in shared.index:
+        return
+    index = min(Histogram.bucket_index(max(0, int(seconds * 1_000_000))), shared.BUCKETS - 1)
+    with _counter_lock:
+        shared.values[shared.offset(_shared_worker, name) + index] += 1
+
+
+def merge_histograms(target: Dict[str, Histogram], source: Dict[str, Histogram]):
+    for name, histogram in source.items():
+        target.setdefault(name, Histogram()).merge(histogram)
+
+
+def format_histograms(histograms: Dict[str, Histogram]) -> List[str]:
+    lines = []
+    for name, histogram in sorted(histograms.items()):
+        values = histogram.percentiles(REPORT_PERCENTILES)
+        percentiles = ", ".join(f"p{p:g} {v * 1000:.1f}ms" for p, v in zip(REPORT_PERCENTILES, values))
+        lines.append(f"{name}: {histogram.total} samples, min {histogram.min / 1000:.1f}ms, "
+                     f"mean {histogram.mean * 1000:.1f}ms, {percentiles}, max {histogram.max / 1000:.1f}ms")
+    return lines
+
+
+def dump_histograms(histograms: Dict[str, Histogram], path: str):
+    report = {}
+    for name, histogram in histograms.items():
+        values = histogram.percentiles(REPORT_PERCENTILES)
+        report[name] = {
+            "count": histogram.total,
+            "min_s": histogram.min / 1_000_000,
+            "mean_s": histogram.mean,
+            "max_s": histogram.max / 1_000_000,
+            "percentiles_s": {f"p{p:g}": v for p, v in zip(REPORT_PERCENTILES, values)},
+        }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=4)
+
+
+COUNTERS = [
+    "connects",
+    "reconnects",
+    "disconnects",
+    "connection_lost",
+    "connect_failures",
+    "reboots",
+    "churns",
+    "commands",
+    "command_errors",
+    "messages_sent",
+    "bytes_sent",
+    "messages_received",
+    "errors",
+    "client_joins",
+    "client_leaves",
+    "client_roams",
+    "shutdown_closes",
+    "shutdown_clean_closes",
+]
+COUNTER_INDEX = {name: i for i, name in enumerate(COUNTERS)}
+
+
+class Counters:
+    """
+    Counters of all worker processes in one shared memory block. Every
+    worker owns a row of the block and is the only one writing to it, the
+    parent process only reads.
+    """
+
+    def __init__(self, workers: int, names: List[str] = COUNTERS):
+        self.workers = workers
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        self.values = multiprocessing.RawArray(ctypes.c_uint64, workers * len(names))
+
+    def add(self, worker: int, name: str, value: int = 1):
+        self.values[worker * len(self.names) + self.index[name]] += value
+
+    def totals(self) -> Dict[str, int]:
+        values = self.values[:]
+        return {name: sum(values[i::len(self.names)]) for i, name in enumerate(self.names)}
+
+
+# histograms the parent process can read while the simulation runs
+LIVE_HISTOGRAMS = ["wss_open", "first_message", "reconnect", "downlink", "ping_rtt"]
+
+
+class SharedHistograms:
+    """
+    Bucket counts of the live histograms of all worker processes in one
+    shared memory block, laid out like Counters: every worker owns a row of
+    buckets per histogram. Values above the last bucket (about 76 hours)
+    are counted in the last bucket.
+    """
+    BUCKETS = Histogram.bucket_index((1 << 38) - 1) + 1
+
+    def __init__(self, workers: int, names: List[str] = LIVE_HISTOGRAMS):
+        self.workers = workers
+        self.names = names
+        self.index = {name: i for i, name in enumerate(names)}
+        self.values = multiprocessing.RawArray(ctypes.c_uint64, workers * len(names) * self.BUCKETS)
+
+    def offset(self, worker: int, name: str) -> int:
+        return (worker * len(self.names) + self.index[name]) * self.BUCKETS
+
+    def buckets(self) -> Dict[str, List[int]]:
+        """Bucket counts of every histogram, summed over all workers."""
+        values = self.values[:]
+        result = {}
+        for name in self.names:
+            rows = [values[self.offset(worker, name):self.offset(worker, name) + self.BUCKETS]
+                    for worker in range(self.workers)]
+            result[name] = [sum(counts) for counts in zip(*rows)]
+        return result
+
+
+# the counters row of the current worker process, see attach_counters
+_counter_values = None
+_counter_offset = 0
+_counter_lock = threading.Lock()
+
+
+# the shared histograms and worker index of the current worker process, see
+# attach_histograms
+_shared_histograms = None
+_shared_worker = 0
+
+
+def attach_counters(counters: Counters, worker: int):
+    global _counter_values, _counter_offset
+    _counter_values = counters.values
+    _counter_offset = worker * len(COUNTERS)
+
+
+def attach_histograms(shared: SharedHistograms, worker: int):
+    global _shared_histograms, _shared_worker
+    _shared_histograms = shared
+    _shared_worker = worker
+
+
+def count(name: str, value: int = 1):
+    if _counter_values is None:
+        return
+    index = _counter_offset + COUNTER_INDEX[name]
+    # only guards against the device threads of this worker
+    with _counter_lock:
+        _counter_values[index] += value
+
+
+class CounterSampler:
+    """Periodically samples the shared counters and logs their rates."""
+
+    def __init__(self, counters: Counters, path: str = None):
+        self.counters = counters
+        self.last = counters.totals()
+        self.last_time = time.monotonic()
+        self.file = None
+        if path:
+            self.file = open(path, "w")
+            self.file.write(",".join(["time"] + COUNTERS) + "\n")
+
+    def sample(self) -> str:
+        now = time.monotonic()
+        totals = self.counters.totals()
+        elapsed = max(now - self.last_time, 1e-9)
+        rates = {name: (totals[name] - self.last[name]) / elapsed for name in COUNTERS}
+        self.last, self.last_time = totals, now
+        if self.file is not None:
+            self.file.write(",".join([f"{time.time():.3f}"] + [str(totals[name]) for name in COUNTERS]) + "\n")
+            self.file.flush()
+        return (f"connected {totals['connects'] - totals['disconnects']}, "
+                f"sent {rates['messages_sent']:.0f} msg/s ({rates['bytes_sent'] / 1e6:.2f} MB/s), "
+                f"received {rates['messages_received']:.0f} msg/s, "
+                f"connects {rates['connects']:.0f}/s, reconnects {totals['reconnects']}, "
+                f"lost {totals['connection_lost']}, connect failures {totals['connect_failures']}, "
+                f"reboots {totals['reboots']}, commands {rates['commands']:.0f}/s "
+                f"({totals['command_errors']} failed), "
+                f"errors {totals['errors']}")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,190 @@
+from dataclasses import dataclass, field
+from typing import BinaryIO, Iterator, List, Tuple
+import struct
+import json
+import time
+import zlib
+
+
+MAGIC = b"WSTRACE1"
+# magic, wall clock time (epoch) the offsets of the records are relative to
+HEADER = struct.Struct("<8sd")
+# offset (s), session, direction, kind | flags, payload length
+RECORD = struct.Struct("<dIBBI")
+
+UPLINK = 0
+DOWNLINK = 1
+
+OPEN = 0
+TEXT = 1
+BINARY = 2
+CLOSE = 3
+KIND_MASK = 0x7F
+COMPRESSED = 0x80
+
+# payloads shorter than this are never compressed
+COMPRESS_MIN = 256
+# shortest time a replayed session takes before it starts over
+MIN_LAP_S = 1.0
+
+
+@dataclass
+class Record:
+    offset: float
+    session: int
+    direction: int
+    kind: int
+    payload: bytes
+
+
+class TraceWriter:
+    """
+    Appends records to a trace file. A trace is a header followed by records,
+    each a fixed size head and its payload; payloads are zlib compressed when
+    that makes them smaller. Records are only ever appended, a trace that was
+    cut short is readable up to its last complete record.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.epoch = time.time()
+            self.file.write(HEADER.pack(MAGIC, self.epoch))
+        else:
+            with open(path, "rb") as f:
+                self.epoch = read_header(f)
+
+    def write(self, session: int, direction: int, kind: int, payload: bytes = b""):
+        if len(payload) >= COMPRESS_MIN:
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                payload = compressed
+                kind |= COMPRESSED
+        self.file.write(RECORD.pack(time.time() - self.epoch, session, direction, kind, len(payload)))
+        self.file.write(payload)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_header(f: BinaryIO) -> float:
+    data = f.read(HEADER.size)
+    if len(data) < HEADER.size:
+        raise ValueError(f"{f.name} is not a trace, it is too short")
+    magic, epoch = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError(f"{f.name} is not a trace")
+    return epoch
+
+
+def read_trace(path: str) -> Iterator[Record]:
+    with open(path, "rb") as f:
+        read_header(f)
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            offset, session, direction, kind, length = RECORD.unpack(head)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            if kind & COMPRESSED:
+                payload = zlib.decompress(payload)
+            yield Record(offset, session, direction, kind & KIND_MASK, payload)
+
+
+@dataclass
+class TraceSession:
+    """Uplink traffic of one recorded device connection, ready to be replayed."""
+    serial: str = None
+    connect: str = None
+    # (seconds since the connection was opened, frame)
+    frames: List[Tuple[float, str]] = field(default_factory=list)
+    duration: float = 0
+
+    def rewrite(self, frame: str, serial: str) -> str:
+        """Replaces the recorded serial (plain and as MAC, in its case) with `serial`."""
+        if self.serial is None:
+            return frame
+        serial = serial.lower() if self.serial.islower() else serial.upper()
+        frame = frame.replace(self.serial, serial)
+        return frame.replace(as_mac(self.serial), as_mac(serial))
+
+
+def as_mac(serial: str) -> str:
+    return ":".join(serial[i:i + 2] for i in range(0, len(serial), 2))
+
+
+def load_sessions(path: str) -> List[TraceSession]:
+    """
+    Loads the uplink frames of all sessions of a trace. The connect message
+    is kept apart, it is sent by the device when it connects, and results of
+    commands are left out: commands of the replay target get their own replies.
+    """
+    # session numbers start over when a recording is appended to a trace,
+    # so they only identify the session opened last with that number
+    opened = {}
+    current = {}
+    sessions = []
+    for record in read_trace(path):
+        if record.direction != UPLINK:
+            continue
+        session = current.get(record.session)
+        if record.kind == OPEN or session is None:
+            opened[record.session] = record.offset
+            session = current[record.session] = TraceSession()
+            sessions.append(session)
+            if record.kind == OPEN:
+                continue
+        offset = record.offset - opened[record.session]
+        session.duration = max(session.duration, offset)
+        if record.kind != TEXT:
+            continue
+        frame = record.payload.decode()
+        try:
+            msg = json.loads(frame)
+        except ValueError:
+            msg = None
+        if isinstance(msg, dict) and msg.get("method") == "connect" and session.connect is None:
+            session.connect = frame
+            session.serial = msg.get("params", {}).get("serial")
+        elif isinstance(msg, dict) and "result" in msg and "method" not in msg:
+            continue
+        else:
+            session.frames.append((offset, frame))
+    return [session for session in sessions if session.frames]
+
+
+class TraceReplay:
+    """
+    Position of a device in the session it replays. Sessions are replayed in
+    a loop, `speed` times faster than recorded.
+    """
+    __slots__ = ("session", "speed", "start", "position", "lap", "timer")
+
+    def __init__(self, session: TraceSession, speed: float):
+        self.session = session
+        self.speed = speed
+        self.start = 0.0
+        self.position = 0
+        self.lap = 0
+        self.timer = None
+
+    def restart(self, now: float):
+        self.start = now
+        self.position = 0
+        self.lap = 0
+
+    def next_frame(self) -> Tuple[float, str]:
+        """Returns the (monotonic) time the next frame is due at and the frame."""
+        offset, frame = self.session.frames[self.position]
+        lap_duration = max(self.session.duration, MIN_LAP_S)
+        when = self.start + (self.lap * lap_duration + offset) / self.speed
+        self.position += 1
+        if self.position == len(self.session.frames):
+            self.position = 0
+            self.lap += 1
+        return when, frame
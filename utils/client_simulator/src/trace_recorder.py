@@ -0,0 +1,158 @@
+from .simulation_runner import get_ssl_context
+from .mock_cgw import get_server_ssl_context
+from .trace import TraceWriter, UPLINK, DOWNLINK, OPEN, TEXT, BINARY, CLOSE
+from .log import logger
+from websockets.asyncio.server import serve, ServerConnection
+from websockets.asyncio import client
+from websockets.exceptions import ConnectionClosed, WebSocketException
+from dataclasses import dataclass
+import argparse
+import asyncio
+import signal
+import os
+import re
+
+
+FLUSH_INTERVAL_S = 1
+
+
+@dataclass
+class RecorderArgs:
+    upstream: str
+    output: str
+    address: str = "0.0.0.0"
+    port: int = 15002
+    cert: str = None
+    key: str = None
+    ca: str = None
+    client_cert: str = None
+    client_key: str = None
+    upstream_ca: str = None
+    check_cert: bool = True
+
+
+def parse_args() -> RecorderArgs:
+    parser = argparse.ArgumentParser(
+        description="Proxy between devices and CGW that records the traffic of every device session "
+                    "to a trace, which the client simulator can replay with --trace.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-l", "--listen", metavar="ADDRESS:PORT",
+                        default="0.0.0.0:15002",
+                        help="address and port to accept device connections on")
+    parser.add_argument("--cert", metavar="CERT",
+                        default=None,
+                        help="path to server certificate; without it the proxy speaks plain ws")
+    parser.add_argument("--key", metavar="KEY",
+                        default=None,
+                        help="path to server key")
+    parser.add_argument("-a", "--ca-cert", metavar="CERT",
+                        default=None,
+                        help="path to CA certificate; if given, devices must present a client "
+                             "certificate signed by it")
+    parser.add_argument("-s", "--server", metavar="ADDRESS",
+                        required=True,
+                        help="CGW to forward device connections to, e.g. wss://cgw:15002")
+    parser.add_argument("-c", "--client-certs-path", metavar="PATH",
+                        default="./certs/client",
+                        help="path to the client certificate (base.crt, base.key) the proxy "
+                             "connects to CGW with")
+    parser.add_argument("--server-ca-cert", metavar="CERT",
+                        default="./certs/ca/ca.crt",
+                        help="path to CA certificate of CGW's certificate")
+    parser.add_argument("-C", "--no-cert-check", action="store_true",
+                        help="do not check CGW's certificate")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        default="trace.bin",
+                        help="trace file the sessions are appended to")
+
+    parsed_args = parser.parse_args()
+
+    match = re.match(r"^([\d\w\.:-]*?):?(\d+)?$", parsed_args.listen)
+    if match is None:
+        raise ValueError(f"Unable to parse listen address {parsed_args.listen}")
+    args = RecorderArgs(upstream=parsed_args.server,
+                        output=parsed_args.output,
+                        cert=parsed_args.cert,
+                        key=parsed_args.key,
+                        ca=parsed_args.ca_cert,
+                        client_cert=os.path.join(parsed_args.client_certs_path, "base.crt"),
+                        client_key=os.path.join(parsed_args.client_certs_path, "base.key"),
+                        upstream_ca=parsed_args.server_ca_cert,
+                        check_cert=not parsed_args.no_cert_check)
+    addr, port = match.groups()
+    if addr:
+        args.address = addr
+    if port is not None:
+        args.port = int(port)
+    return args
+
+
+class TraceRecorder:
+    """
+    Forwards every device connection to CGW and appends the frames of both
+    directions to the trace, with the time they passed the proxy.
+    """
+
+    def __init__(self, args: RecorderArgs):
+        self.args = args
+        self.writer = TraceWriter(args.output)
+        self.next_session = 0
+        self.upstream_ssl = None
+        if args.upstream.startswith("wss://"):
+            self.upstream_ssl = get_ssl_context(args.client_cert, args.client_key, args.upstream_ca,
+                                                args.check_cert)
+
+    async def pump(self, source, target, session: int, direction: int):
+        try:
+            async for frame in source:
+                if isinstance(frame, str):
+                    self.writer.write(session, direction, TEXT, frame.encode())
+                else:
+                    self.writer.write(session, direction, BINARY, frame)
+                await target.send(frame)
+        except ConnectionClosed:
+            pass
+        finally:
+            # the other direction ends once its source is closed
+            await target.close()
+
+    async def handler(self, device: ServerConnection):
+        session = self.next_session
+        self.next_session += 1
+        logger.info(f"session {session}: {device.remote_address} connected")
+        self.writer.write(session, UPLINK, OPEN)
+        try:
+            async with client.connect(self.args.upstream, ssl=self.upstream_ssl, open_timeout=20,
+                                      ping_interval=None, max_size=None) as upstream:
+                await asyncio.gather(self.pump(device, upstream, session, UPLINK),
+                                     self.pump(upstream, device, session, DOWNLINK))
+        except (OSError, TimeoutError, WebSocketException) as e:
+            logger.warning(f"session {session}: unable to connect to {self.args.upstream}: {e!r}")
+        finally:
+            self.writer.write(session, UPLINK, CLOSE)
+            logger.info(f"session {session}: closed")
+
+    async def flush(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL_S)
+            self.writer.flush()
+
+    async def run(self):
+        stop = asyncio.get_running_loop().create_future()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, stop.set_result, None)
+        ssl_context = get_server_ssl_context(self.args.cert, self.args.key, self.args.ca)
+        async with serve(self.handler, self.args.address, self.args.port, ssl=ssl_context,
+                         ping_interval=None, max_size=None):
+            proto = "wss" if ssl_context else "ws"
+            logger.info(f"recording {proto}://{self.args.address}:{self.args.port} -> {self.args.upstream} "
+                        f"to {self.args.output}")
+            flush = asyncio.create_task(self.flush())
+            await stop
+            flush.cancel()
+        self.writer.close()
+        logger.info(f"{self.next_session} sessions recorded")
+
+
+def main(args: RecorderArgs):
+    asyncio.run(TraceRecorder(args).run())
@@ -0,0 +1,76 @@
+from dataclasses import dataclass, field
+from typing import List
+import functools
+import random
+import re
+
+
+MESSAGE_TYPES = ["state", "state_obf", "log", "join", "leave"]
+
+
+@dataclass
+class TrafficStream:
+    """
+    Messages a device sends periodically: every `period` seconds it sends
+    `burst` messages, each of one of `types` picked by `weights`.
+    """
+    period: float
+    types: List[str]
+    weights: List[float] = field(default_factory=list)
+    burst: int = 1
+
+    def pick(self) -> str:
+        if len(self.types) == 1:
+            return self.types[0]
+        return random.choices(self.types, self.weights)[0]
+
+
+@functools.cache
+def default_traffic_mix(interval: float) -> List[TrafficStream]:
+    # shared by all devices with the same interval, streams are never modified
+    return [TrafficStream(interval, ["state"]), TrafficStream(interval, ["log"])]
+
+
+def parse_period(input: str) -> float:
+    match = re.match(r"^(\d+(?:\.\d+)?)?(ms|s|m|h)$", input)
+    if match is None:
+        raise ValueError(f"Unable to parse period \"{input}\"")
+    num, unit = match.groups()
+    num = float(num) if num is not None else 1.0
+    return num * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+
+
+def parse_traffic_mix(spec: str, interval: float, scale: float = 1.0) -> List[TrafficStream]:
+    """
+    Parses a comma separated list of message types with their rates per
+    device, e.g. "state:1/60s,join:5/s,leave:5/s,log:1/10s*20":
+
+    TYPE:N/PERIOD    send N messages of TYPE every PERIOD (ms, s, m or h)
+    TYPE:N/PERIOD*B  same, but each send is a burst of B messages
+    TYPE:W           weighted type; all weighted types together send one
+                     message per device every `interval` seconds, picked
+                     randomly by weight W
+
+    The periods of the TYPE:N/PERIOD entries are multiplied by `scale`.
+    """
+    streams = []
+    weighted = TrafficStream(interval, [], [])
+    for entry in spec.split(","):
+        match = re.match(r"^(\w+):(?:(\d+(?:\.\d+)?)/([\d.]*(?:ms|s|m|h))(?:\*(\d+))?|(\d+(?:\.\d+)?))$",
+                         entry.strip())
+        if match is None:
+            raise ValueError(f"Unable to parse traffic mix entry \"{entry}\"")
+        name, count, period, burst, weight = match.groups()
+        if name not in MESSAGE_TYPES:
+            raise ValueError(f"Unknown message type \"{name}\", expected one of {MESSAGE_TYPES}")
+        if weight is not None:
+            weighted.types.append(name)
+            weighted.weights.append(float(weight))
+            continue
+        if float(count) <= 0:
+            raise ValueError(f"Message rate of \"{entry}\" must be positive")
+        streams.append(TrafficStream(parse_period(period) * scale / float(count), [name],
+                                     burst=int(burst) if burst else 1))
+    if weighted.types:
+        streams.append(weighted)
+    return streams
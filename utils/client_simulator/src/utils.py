@@ -1,7 +1,10 @@
-from dataclasses import dataclass
-from typing import List
+from .scheduler import RAMP_PROFILES
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+import functools
 import argparse
 import random
+import copy
 import json
 import re
 import os
@@ -19,11 +22,60 @@ class Args:
     msg_size: int
     msg_interval: int
     wait_for_sig: bool
+    engine: str = "thread"
+    tls_session_reuse: bool = False
+    connect_rate: float = 0
+    ramp_profile: str = "linear"
+    ramp_step: int = 1
+    ramp_jitter: float = 0
+    latency_report: str = None
+    counters_file: str = None
+    traffic_mix: str = None
+    reconnect_delay: float = 1
+    reconnect_max_delay: float = 60
+    reconnect_jitter: float = 0.5
+    reboot_time: str = "10s"
+    command_replies: List[str] = field(default_factory=list)
+    max_connections: int = None
+    control: str = None
+    log_rate: float = 0
+    log_samples: Dict[str, float] = field(default_factory=dict)
+    log_file: str = None
+    workers: int = 1
+    pin_cpus: bool = True
+    source_addresses: List[str] = field(default_factory=list)
+    ping_sample: float = 0
+    ping_interval: float = 10
+    trace: str = None
+    trace_speed: float = 1
+    saturate: str = None
+    saturate_step: int = 100
+    saturate_rate_step: float = 1.25
+    saturate_hold: float = 30
+    slo_latency: str = "wss_open:1s"
+    slo_errors: float = 0.01
+    slo_connected: float = 0.99
+    cgw_metrics: List[str] = field(default_factory=list)
+    saturation_report: str = None
+    roaming_clients: int = 0
+    roaming_group_size: int = 8
+    roaming_dwell: str = "exp(10m)"
+    roaming_away: str = "exp(30m)"
+    roaming_ratio: float = 0.7
+    session_lifetime: str = None
+    churn_rate: float = 0
+    churn_offline: str = "1s"
+    event_log: str = None
+    shutdown_timeout: float = 5
     server_proto: str = "ws"
     server_address: str = "localhost"
     server_port: int = 50001
     check_cert: bool = True
 
+    def __post_init__(self):
+        if self.max_connections is None:
+            self.max_connections = self.number_of_connections
+
     @property
     def server(self):
         return f"{self.server_proto}://{self.server_address}:{self.server_port}"
@@ -42,6 +94,23 @@ def parse_msg_size(input: str) -> int:
     return num
 
 
+def parse_rate(input: str) -> float:
+    match = re.match(r"^(\d+(?:\.\d+)?)(?:/s)?$", input)
+    if match is None:
+        raise ValueError(f"Unable to parse rate \"{input}\"")
+    return float(match.group(1))
+
+
+def parse_log_samples(inputs: List[str]) -> Dict[str, float]:
+    samples = {}
+    for input in inputs:
+        match = re.match(r"^(\w+):(\d*\.?\d+)$", input)
+        if match is None or float(match.group(2)) > 1:
+            raise ValueError(f"Unable to parse log sample ratio \"{input}\"")
+        samples[match.group(1)] = float(match.group(2))
+    return samples
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Used to simulate multiple clients that connect to a single server.",
@@ -52,12 +121,100 @@ def parse_args():
                         help="server address")
     parser.add_argument("-N", "--number-of-connections", metavar="NUMBER", type=int,
                         default=1,
-                        help="number of concurrent connections per thread pool")
+                        help="number of concurrent connections per MAC mask")
+    parser.add_argument("--max-connections", metavar="NUMBER", type=int,
+                        default=None,
+                        help="number of devices per MAC mask the simulation can be scaled up to "
+                             "with the control API (default: --number-of-connections)")
     parser.add_argument("-M", "--mac-mask", metavar="XX:XX:XX:XX:XX:XX", action="append",
                         default=[],
-                        help="the mask determines what MAC addresses will be used by clients "
-                             "in the thread pool. Specifying multiple masks will increase "
-                             "the number of thread pools used.")
+                        help="the mask determines what MAC addresses will be used by clients. "
+                             "Specifying multiple masks simulates NUMBER devices of each mask.")
+    parser.add_argument("-W", "--workers", metavar="NUMBER", type=int,
+                        default=os.cpu_count(),
+                        help="number of worker processes the devices are evenly distributed across")
+    parser.add_argument("--no-cpu-pinning", action="store_true",
+                        help="do not pin every worker process to its own CPU")
+    parser.add_argument("--source-address", metavar="ADDRESS", action="append",
+                        default=[],
+                        help="bind device connections round-robin to these local addresses: an address, "
+                             "a network (e.g. 127.0.0.0/24) or a range (e.g. 10.0.0.5-10.0.0.20); every "
+                             "address adds its own ~28k ephemeral ports")
+    parser.add_argument("--ping-sample", metavar="FRACTION", type=float,
+                        default=0,
+                        help="fraction of the connections that send a WebSocket ping every --ping-interval "
+                             "and record the round trip time (ping_rtt)")
+    parser.add_argument("--ping-interval", metavar="SECONDS", type=float,
+                        default=10,
+                        help="time between probe pings of a connection")
+    parser.add_argument("--trace", metavar="FILE", type=str,
+                        default=None,
+                        help="replay the sessions recorded by trace_recorder.py instead of sending the "
+                             "traffic mix; sessions are dealt to the devices round-robin")
+    parser.add_argument("--trace-speed", metavar="FACTOR", type=float,
+                        default=1,
+                        help="replay traces FACTOR times faster than recorded, e.g. 1 to 100")
+    parser.add_argument("--saturate", choices=["devices", "rate"],
+                        default=None,
+                        help="raise the load step by step, by adding devices (up to --max-connections) "
+                             "or by sending faster, until an SLO breaks, then report the maximum "
+                             "sustainable load and stop")
+    parser.add_argument("--saturate-step", metavar="NUMBER", type=int,
+                        default=100,
+                        help="devices per MAC mask added every step when saturating devices")
+    parser.add_argument("--saturate-rate-step", metavar="FACTOR", type=float,
+                        default=1.25,
+                        help="message rate multiplier of every step when saturating the message rate")
+    parser.add_argument("--saturate-hold", metavar="SECONDS", type=float,
+                        default=30,
+                        help="duration of every step; rates are measured over its last 3/4")
+    parser.add_argument("--slo-latency", metavar="NAME:DURATION", type=str,
+                        default="wss_open:1s",
+                        help="p99 latency SLO: the p99 of NAME (wss_open, first_message, reconnect, "
+                             "downlink or ping_rtt) must stay below DURATION")
+    parser.add_argument("--slo-errors", metavar="RATIO", type=float,
+                        default=0.01,
+                        help="error ratio SLO: failed connects, lost connections and errors over all "
+                             "connect attempts and sent messages")
+    parser.add_argument("--slo-connected", metavar="RATIO", type=float,
+                        default=0.99,
+                        help="minimum ratio of the devices of a step that have to be connected")
+    parser.add_argument("--cgw-metrics", metavar="URL", action="append",
+                        default=[],
+                        help="metrics endpoint of a CGW instance, e.g. http://cgw:8080/metrics, read "
+                             "after every step")
+    parser.add_argument("--saturation-report", metavar="FILE", type=str,
+                        default=None,
+                        help="write the steps and the maximum sustainable load to FILE (JSON)")
+    parser.add_argument("--roaming-clients", metavar="NUMBER", type=int,
+                        default=0,
+                        help="number of wireless clients moving between the APs of every roaming group, "
+                             "sending client join and leave events; 0 disables roaming")
+    parser.add_argument("--roaming-group-size", metavar="NUMBER", type=int,
+                        default=8,
+                        help="number of APs (consecutive devices of a MAC mask) of a roaming group")
+    parser.add_argument("--roaming-dwell", metavar="DIST", type=str,
+                        default="exp(10m)",
+                        help="how long a client stays with an AP, a duration or a distribution like "
+                             "--reboot-time")
+    parser.add_argument("--roaming-away", metavar="DIST", type=str,
+                        default="exp(30m)",
+                        help="how long a client that left its group stays away")
+    parser.add_argument("--roaming-ratio", metavar="RATIO", type=float,
+                        default=0.7,
+                        help="probability that a client roams to another AP of its group when its dwell "
+                             "time is over, instead of leaving the group")
+    parser.add_argument("--session-lifetime", metavar="DIST", type=str,
+                        default=None,
+                        help="churn: close every connection after a lifetime drawn from DIST, a duration or "
+                             "a distribution like --reboot-time, and reconnect with a new connect message")
+    parser.add_argument("--churn-rate", metavar="N/s", type=str,
+                        default="0",
+                        help="churn: sessions of all devices end at N per second on average (exponential "
+                             "session lifetimes); ignored with --session-lifetime")
+    parser.add_argument("--churn-offline", metavar="DIST", type=str,
+                        default="1s",
+                        help="churn: how long a device stays disconnected before it reconnects")
     parser.add_argument("-a", "--ca-cert", metavar="CERT",
                         default="./certs/ca/ca.crt",
                         help="path to CA certificate")
@@ -73,8 +230,83 @@ def parse_args():
     parser.add_argument("-p", "--payload-size", metavar="SIZE", type=str,
                         default="1k",
                         help="size of each client message")
+    parser.add_argument("--traffic-mix", metavar="SPEC", type=str,
+                        default=None,
+                        help="message types and their rates per device, e.g. "
+                             "\"state:1/60s,join:5/s,leave:5/s,log:1/10s*20\"; by default every "
+                             "device sends a state and a log message every message interval")
     parser.add_argument("-w", "--wait-for-signal", action="store_true",
                         help="wait for SIGUSR1 before running simulation")
+    parser.add_argument("--control", metavar="HOST:PORT|unix:PATH", type=str,
+                        default=None,
+                        help="serve the HTTP control API (start, stop, scale, change message interval "
+                             "and size, drop connections) on a TCP port or a unix socket")
+    parser.add_argument("-e", "--engine", choices=["thread", "asyncio"],
+                        default="thread",
+                        help="how devices are driven inside a process: one OS thread per device, "
+                             "or one coroutine per device on a single event loop")
+    parser.add_argument("--tls-session-reuse", action="store_true",
+                        help="resume the previous TLS session when a device reconnects")
+    parser.add_argument("-r", "--connect-rate", metavar="N/s", type=str,
+                        default="0",
+                        help="number of devices that start connecting each second, shared by all "
+                             "processes; 0 connects all devices at once")
+    parser.add_argument("--ramp-profile", choices=RAMP_PROFILES,
+                        default="linear",
+                        help="how device arrivals are distributed over time when connect rate is set")
+    parser.add_argument("--ramp-step", metavar="NUMBER", type=int,
+                        default=100,
+                        help="number of devices connecting together with the 'step' ramp profile")
+    parser.add_argument("--ramp-jitter", metavar="SECONDS", type=float,
+                        default=0,
+                        help="random delay of up to SECONDS added to each device's connect time")
+    parser.add_argument("--reconnect-delay", metavar="SECONDS", type=float,
+                        default=1,
+                        help="delay before the first reconnect attempt of a device that lost its "
+                             "connection; doubles with every failed attempt")
+    parser.add_argument("--reconnect-max-delay", metavar="SECONDS", type=float,
+                        default=60,
+                        help="upper limit of the reconnect delay")
+    parser.add_argument("--reconnect-jitter", metavar="FRACTION", type=float,
+                        default=0.5,
+                        help="every reconnect delay is randomly shortened by up to this fraction")
+    parser.add_argument("--reboot-time", metavar="DIST", type=str,
+                        default="10s",
+                        help="how long a device stays offline after a reboot request: a duration or a "
+                             "distribution, e.g. \"uniform(5s,30s)\", \"normal(20s,5s)\", \"exp(15s)\" "
+                             "or \"lognormal(10s,0.5)\"")
+    parser.add_argument("--command-reply", metavar="METHOD:DELAY[:ERRORS]", action="append",
+                        default=[],
+                        help="reply to downlink commands of METHOD (or \"*\" for all others) after "
+                             "DELAY, a duration or a distribution like --reboot-time, failing the given "
+                             "ratio of them, e.g. \"configure:uniform(1s,3s):0.05\"; by default all "
+                             "commands succeed immediately")
+    parser.add_argument("--log-rate", metavar="N/s", type=str,
+                        default="0",
+                        help="log at most N messages per second from each logging function (the name "
+                             "after the thread in every log line); 0 logs everything")
+    parser.add_argument("--log-sample", metavar="FUNCTION:RATIO", action="append",
+                        default=[],
+                        help="only log the given ratio of the messages of a logging function, e.g. "
+                             "\"handle_messages:0.01\"")
+    parser.add_argument("--log-file", metavar="FILE", type=str,
+                        default=None,
+                        help="also append all log messages to FILE as JSON lines")
+    parser.add_argument("--shutdown-timeout", metavar="SECONDS", type=float,
+                        default=5,
+                        help="on stop, all connections are closed at once; those without a completed close "
+                             "handshake after SECONDS are aborted")
+    parser.add_argument("--latency-report", metavar="FILE", type=str,
+                        default=None,
+                        help="write latency percentiles of all processes to FILE (JSON) on exit")
+    parser.add_argument("--event-log", metavar="PREFIX", type=str,
+                        default=None,
+                        help="write the lifecycle events of every device (connects, disconnects and their "
+                             "reasons, downlink messages, responses) to PREFIX.WORKER, one columnar file "
+                             "per worker; read them with event_log.py")
+    parser.add_argument("--counters-file", metavar="FILE", type=str,
+                        default=None,
+                        help="append the counters of all processes to FILE (CSV) once a second")
 
     parsed_args = parser.parse_args()
 
@@ -89,10 +321,60 @@ def parse_args():
                 msg_interval=parsed_args.msg_interval,
                 msg_size=parse_msg_size(parsed_args.payload_size),
                 check_cert=not no_cert_check,
-                wait_for_sig=parsed_args.wait_for_signal)
+                wait_for_sig=parsed_args.wait_for_signal,
+                engine=parsed_args.engine,
+                tls_session_reuse=parsed_args.tls_session_reuse,
+                connect_rate=parse_rate(parsed_args.connect_rate),
+                ramp_profile=parsed_args.ramp_profile,
+                ramp_step=parsed_args.ramp_step,
+                ramp_jitter=parsed_args.ramp_jitter,
+                latency_report=parsed_args.latency_report,
+                counters_file=parsed_args.counters_file,
+                traffic_mix=parsed_args.traffic_mix,
+                reconnect_delay=parsed_args.reconnect_delay,
+                reconnect_max_delay=parsed_args.reconnect_max_delay,
+                reconnect_jitter=parsed_args.reconnect_jitter,
+                reboot_time=parsed_args.reboot_time,
+                command_replies=parsed_args.command_reply,
+                max_connections=max(parsed_args.max_connections or 0, parsed_args.number_of_connections),
+                control=parsed_args.control,
+                log_rate=parse_rate(parsed_args.log_rate),
+                log_samples=parse_log_samples(parsed_args.log_sample),
+                log_file=parsed_args.log_file,
+                pin_cpus=not parsed_args.no_cpu_pinning,
+                source_addresses=parsed_args.source_address,
+                ping_sample=parsed_args.ping_sample,
+                ping_interval=parsed_args.ping_interval,
+                trace=parsed_args.trace,
+                trace_speed=parsed_args.trace_speed,
+                saturate=parsed_args.saturate,
+                saturate_step=parsed_args.saturate_step,
+                saturate_rate_step=parsed_args.saturate_rate_step,
+                saturate_hold=parsed_args.saturate_hold,
+                slo_latency=parsed_args.slo_latency,
+                slo_errors=parsed_args.slo_errors,
+                slo_connected=parsed_args.slo_connected,
+                cgw_metrics=parsed_args.cgw_metrics,
+                saturation_report=parsed_args.saturation_report,
+                roaming_clients=parsed_args.roaming_clients,
+                roaming_group_size=parsed_args.roaming_group_size,
+                roaming_dwell=parsed_args.roaming_dwell,
+                roaming_away=parsed_args.roaming_away,
+                roaming_ratio=parsed_args.roaming_ratio,
+                session_lifetime=parsed_args.session_lifetime,
+                churn_rate=parse_rate(parsed_args.churn_rate),
+                churn_offline=parsed_args.churn_offline,
+                event_log=parsed_args.event_log,
+                shutdown_timeout=parsed_args.shutdown_timeout)
 
     if len(args.masks) == 0:
         args.masks.append("XX:XX:XX:XX:XX:XX")
+    if args.trace_speed <= 0:
+        raise ValueError("Trace speed must be positive")
+    if args.roaming_group_size < 1:
+        raise ValueError("Roaming group size must be at least 1")
+    # no worker without devices
+    args.workers = max(1, min(parsed_args.workers, args.max_connections * len(args.masks)))
 
     # PROTO :// ADDRESS : PORT
     # TODO: fixme the host portion can contain a lot more than just these characters!
@@ -114,11 +396,41 @@ def rand_mac(mask="02:xx:xx:xx:xx:xx"):
     return ''.join([n.lower().replace('x', f'{random.randint(0, 15):x}') for n in mask])
 
 
+@functools.cache
 def get_msg_templates():
+    # parsed once per process, callers must not modify the returned templates
     with open(TEMPLATE_LOCATION, "r") as templates:
         return json.loads(templates.read())
 
 
+class MessageTemplates:
+    MAC_PLACEHOLDER = "MAC"
+    PAYLOAD_PLACEHOLDER = "PAYLOAD"
+
+    def __init__(self, templates: dict):
+        # every template is serialized only once and split at the MAC
+        # placeholders, so rendering a device frame is a single str.join
+        self.segments = {name: json.dumps(template).split(self.MAC_PLACEHOLDER)
+                         for name, template in templates.items()}
+        log = copy.deepcopy(templates["log"])
+        log["params"]["data"] = {"msg": self.PAYLOAD_PLACEHOLDER}
+        head, tail = json.dumps(log).split(self.PAYLOAD_PLACEHOLDER)
+        self.log_segments = (head.split(self.MAC_PLACEHOLDER), tail.split(self.MAC_PLACEHOLDER))
+
+    def render(self, name: str, mac: str) -> str:
+        return mac.join(self.segments[name])
+
+    def render_log_ends(self, mac: str) -> Tuple[str, str]:
+        """Returns the log frame of a device before and after its payload."""
+        head, tail = self.log_segments
+        return mac.join(head), mac.join(tail)
+
+
+@functools.cache
+def get_message_templates() -> MessageTemplates:
+    return MessageTemplates(get_msg_templates())
+
+
 def gen_certificates(mask: str, count=int):
     cwd = os.getcwd()
     os.chdir("../cert_generator")
@@ -3,6 +3,7 @@ from typing import List, Tuple
 import copy
 import json
 import uuid
+import time
 
 
 class MacRange:
@@ -140,11 +141,22 @@ class Message:
     MAC = "infra_group_infra"
     DATA = "msg"
     MSG_UUID = "uuid"
+    # (epoch) time the device message was produced, the client simulator
+    # measures the downlink latency with it
+    ISSUED_AT = "issued_at"
 
     def __init__(self) -> None:
         with open(self.TEMPLATE_FILE) as f:
             self.templates = json.loads(f.read())
 
+    @staticmethod
+    def stamp(data: dict) -> dict:
+        if type(data.get("params")) is not dict:
+            return data
+        msg = copy.copy(data)
+        msg["params"] = dict(data["params"], **{Message.ISSUED_AT: time.time()})
+        return msg
+
     @staticmethod
     def parse_uuid(uuid_val = None) -> str:
         if uuid_val is None:
@@ -204,7 +216,7 @@ class Message:
         msg[self.GROUP_ID] = id
         msg[self.MAC] = mac
         if type(data) is dict:
-            msg[self.DATA] = data
+            msg[self.DATA] = Message.stamp(data)
         else:
             msg[self.DATA] = {"data": data}
         #msg[self.MSG_UUID] = str(uuid.uuid1(node=MacRange.mac2num(mac), clock_seq=sequence))